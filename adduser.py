@@ -51,33 +51,45 @@
 #		--password=xxxxxxx \
 #		--appid="api_xxxxxxxxxxxxxxxxxxxx" \
 #		--newuser=someone@domain.com
+#
+# Bulk mode:
+# Instead of --email, --firstname and --lastname, pass --file with a CSV file
+# (header row: email,firstname,lastname) or a JSONL file (one object per line
+# with the same keys). All invites are sent over one login, several at a time,
+# and one result line is printed per row. Emails that already belong to a
+# Yadle user are skipped.
+#
+# The following arguments are optional in bulk mode:
+#   --workers		how many invites to send at the same time (default 4)
+#   --rate		the most invites to send per second (default no limit)
+#
+#   Example usage:
+#	python adduser.py \
+#		--apiserver="https://yadle11.yadle.com" \
+#		--user=yadle \
+#		--password=xxxxxxx \
+#		--appid="api_xxxxxxxxxxxxxxxxxxxx" \
+#		--file=new_users.csv \
+#		--workers=8 \
+#		--rate=5
 
 
 
-import requests
+import yadle_auth
+import yadle_client
+import yadle_json
+import getusers
+import sys
 import json
-import pprint
-import traceback, sys
-import argparse
-
 
 
-def logIn(apiserver, username, password):
-    url = "{0}/yadle/v2/auth/login".format(apiserver)
-    payload = "username={0}&password={1}&undefined=".format(username, password)
-    headers = {
-        'Content-Type': "application/x-www-form-urlencoded",
-        }
 
-    response = requests.request("POST", url, data=payload, headers=headers)
+def logIn(apiserver, username, password, client=None):
+    # Reuses a bearer cached by an earlier run when there is one (see yadle_auth.py).
+    return yadle_auth.logIn(apiserver, username, password, client=client)
 
-    # get Bearer
-    res = json.loads(response.text)
-    bearer = "Bearer {0}:{1}".format(res['token'], res['password'])
-    return bearer
 
-
-def addUser(bearer, appid, apiserver, email, firstname, lastname):
+def inviteRequest(bearer, appid, apiserver, email, firstname, lastname, client=None):
 
 	url = "{0}/yadle/v2/user/invite".format(apiserver)
 
@@ -94,29 +106,113 @@ def addUser(bearer, appid, apiserver, email, firstname, lastname):
 	}
 
 
-	response = requests.request("POST", url, data=payload, headers=headers)
+	return yadle_client.request("POST", url, data=payload, headers=headers, client=client)
+
 
-	pprint.pprint(response)
+def addUser(bearer, appid, apiserver, email, firstname, lastname, client=None):
+	response = inviteRequest(bearer, appid, apiserver, email, firstname, lastname, client=client)
+
+	yadle_json.echo(response, pretty=True)
 
 	return
 
 
+def readInvites(path):
+	# Rows of {'email', 'firstname', 'lastname'} from a CSV or JSONL file.
+	with open(path) as f:
+		if path.endswith('.jsonl') or path.endswith('.json'):
+			rows = [json.loads(line) for line in f if line.strip()]
+		else:
+			import csv
+			rows = list(csv.DictReader(f))
+
+	return [dict((k.strip().lower(), (v or '').strip()) for k, v in row.items()) for row in rows]
+
+
+def existingEmails(bearer, appid, apiserver, client=None):
+	# Lower-cased emails (or ids) of all current users.
+	emails = set()
+	for u in getusers.streamUsers(bearer, appid, apiserver, None, None, client=client):
+		for key in ('email', 'id'):
+			if u.get(key):
+				emails.add(u[key].lower())
+
+	return emails
+
+
+def addUsers(bearer, appid, apiserver, invites, workers=4, rate=None, skipExisting=True, client=None):
+	# Invite many users concurrently. Returns one (row, result) pair per row, in order,
+	# where result is the HTTP status code, 'skipped', or the error raised.
+	skip = set()
+	if skipExisting:
+		skip = existingEmails(bearer, appid, apiserver, client=client)
+
+	limiter = yadle_client.RateLimiter(rate) if rate else None
+
+	def rowsToSend():
+		# Also skips repeated emails within the file.
+		for row in invites:
+			email = row.get('email', '').lower()
+			yield row, bool(email) and email not in skip
+			skip.add(email)
+
+	def invite(item):
+		row, send = item
+		if not send:
+			return row, 'skipped'
+
+		if limiter is not None:
+			limiter.acquire()
+
+		try:
+			response = inviteRequest(bearer, appid, apiserver, row['email'], row.get('firstname', ''),
+				row.get('lastname', ''), client=client)
+			return row, response.status_code
+		except Exception as e:
+			return row, e
+
+	results = []
+	for row, result in yadle_client.bounded_map(invite, rowsToSend(), workers):
+		yadle_json.echo(result, prefix=row.get('email', '') + ' ')
+		results.append((row, result))
+
+	return results
+
+
 
 def main():
+	import argparse
+
 	parser = argparse.ArgumentParser()
 	parser.add_argument("--apiserver", required=True)
 	parser.add_argument("--user", required=True)
 	parser.add_argument("--password", required=True)
 	parser.add_argument("--appid", required=True)
-	parser.add_argument("--email", required=True)
-	parser.add_argument("--firstname", required=True)
-	parser.add_argument("--lastname", required=True)
+	parser.add_argument("--email", required=False)
+	parser.add_argument("--firstname", required=False)
+	parser.add_argument("--lastname", required=False)
+	parser.add_argument("--file", required=False)
+	parser.add_argument("--workers", required=False, type=int, default=4)
+	parser.add_argument("--rate", required=False, type=float)
 
 	args = parser.parse_args()
 
+	if args.file is None and not (args.email and args.firstname and args.lastname):
+		parser.error("either --file or all of --email, --firstname and --lastname are required")
+
 	# log in and get the bearer that will be used to authenticate for subsequent API calls.
 	bearer = logIn(args.apiserver, args.user, args.password)
 
+	if args.file is not None:
+		addUsers(
+			bearer=bearer,
+			appid=args.appid,
+			apiserver=args.apiserver,
+			invites=readInvites(args.file),
+			workers=args.workers,
+			rate=args.rate)
+		return
+
 	addUser(
 		bearer=bearer,
 		appid=args.appid,
@@ -5,31 +5,34 @@
     The main() function at the bottom contains an actual example of creating and
     modifying an aggregate.
 
+    run_manifest() does the same kind of work for many aggregates at once: each
+    manifest entry describes one aggregate and the operations to apply to it.
+    Aggregates are processed concurrently, the operations of one aggregate in
+    order, and redundant operations are dropped before anything is sent.
+
+    The functions that change aggregates take an optional index= argument, a
+    yadle_aggregate_index.AggregateIndex that is updated when they succeed.
+
     See https://api.yadle.com/ for full documentation of the Yadle API.
 """
 
-import requests
-import json
+import yadle_auth
+import yadle_client
+import yadle_json
 import traceback
+import json
 
 
-def logIn(apiserver, username, password):
-    url = "{0}/yadle/v2/auth/login".format(apiserver)
-    payload = "username={0}&password={1}&undefined=".format(username, password)
-    headers = {
-        'Content-Type': "application/x-www-form-urlencoded",
-        }
+def logIn(apiserver, username, password, client=None):
+    # Reuses a bearer cached by an earlier run when there is one (see yadle_auth.py).
+    return yadle_auth.logIn(apiserver, username, password, client=client)
 
-    response = requests.request("POST", url, data=payload, headers=headers)
- 
-    # get Bearer
-    res = json.loads(response.text)
-    bearer = "Bearer {0}:{1}".format(res['token'], res['password'])
-    return bearer
 
+def get_file_info(file_id, server, bearer, app_id, client=None, cache=None):
+    # Pass a yadle_file_cache.FileDocCache as cache to reuse documents fetched earlier.
+    if cache is not None:
+        return cache.get_file_info(file_id, server, bearer, app_id, client=client)
 
-def get_file_info(file_id, server, bearer, app_id):
-    
     url = "{0}/yadle/v2/file/{1}".format(server, file_id)
     payload = ""
     headers = {
@@ -38,18 +41,18 @@ def get_file_info(file_id, server, bearer, app_id):
         'cache-control': "no-cache"
         }
 
-    response = requests.request("GET", url, data=payload, headers=headers)
+    response = yadle_client.request("GET", url, data=payload, headers=headers, client=client)
 
     if not response:
         print('ERROR: ' + url + ' returns a null response ' + str(response))
-        print(str(json.loads(response.text)))
+        print(str(yadle_json.decode(response)))
         return None
 
-    return json.loads(response.text)
+    return yadle_json.decode(response)
 
 
 
-def create_aggregate(file_id, member_list, server, bearer, app_id):
+def create_aggregate(file_id, member_list, server, bearer, app_id, client=None, index=None):
     url = "{0}/yadle/v2/file/{1}/aggregate/new".format(server, file_id)
 
     headers = {
@@ -58,12 +61,16 @@ def create_aggregate(file_id, member_list, server, bearer, app_id):
         'Content-Type': 'application/json'
     }
 
-    response = requests.request("POST", url, headers=headers, json=member_list)
+    response = yadle_client.request("POST", url, headers=headers, json=member_list, client=client)
+
+    res = yadle_json.decode(response, echo_level=1)
 
-    print(json.loads(response.text))
-    return json.loads(response.text)
+    if index is not None and 'aggregate_id' in res:
+        index.set_aggregate(res['aggregate_id'], file_id, member_list)
 
-def remove_aggregate_members(file_id, aggregate_id, members_to_remove, server, bearer, app_id):
+    return res
+
+def remove_aggregate_members(file_id, aggregate_id, members_to_remove, server, bearer, app_id, client=None, index=None):
     url = "{0}/yadle/v2/file/{1}/aggregate/{2}".format(server, file_id, aggregate_id)
 
     headers = {
@@ -72,12 +79,16 @@ def remove_aggregate_members(file_id, aggregate_id, members_to_remove, server, b
         'Content-Type': 'application/json'
     }
 
-    response = requests.request("DELETE", url, headers=headers, json=members_to_remove)
+    response = yadle_client.request("DELETE", url, headers=headers, json=members_to_remove, client=client)
+
+    res = yadle_json.decode(response, echo_level=1)
 
-    print(json.loads(response.text))
-    return json.loads(response.text)
+    if index is not None and 'error' not in res:
+        index.remove_members(aggregate_id, members_to_remove)
 
-def add_additional_aggregate_members(file_id, aggregate_id, files_to_add, server, bearer, app_id):
+    return res
+
+def add_additional_aggregate_members(file_id, aggregate_id, files_to_add, server, bearer, app_id, client=None, index=None):
     url = "{0}/yadle/v2/file/{1}/aggregate/{2}".format(server, file_id, aggregate_id)
 
     headers = {
@@ -86,12 +97,16 @@ def add_additional_aggregate_members(file_id, aggregate_id, files_to_add, server
         'Content-Type': 'application/json'
     }
 
-    response = requests.request("PATCH", url, headers=headers, json=files_to_add)
+    response = yadle_client.request("PATCH", url, headers=headers, json=files_to_add, client=client)
+
+    res = yadle_json.decode(response, echo_level=1)
 
-    print(json.loads(response.text))
-    return json.loads(response.text)
+    if index is not None and 'error' not in res:
+        index.add_members(aggregate_id, files_to_add)
 
-def get_aggregate(file_id, aggregate_id, server, bearer, app_id):
+    return res
+
+def get_aggregate(file_id, aggregate_id, server, bearer, app_id, client=None):
     url = "{0}/yadle/v2/file/{1}/aggregate/{2}".format(server, file_id, aggregate_id)
 
     headers = {
@@ -100,12 +115,11 @@ def get_aggregate(file_id, aggregate_id, server, bearer, app_id):
         'Content-Type': 'application/json'
     }
 
-    response = requests.request("GET", url, headers=headers)
+    response = yadle_client.request("GET", url, headers=headers, client=client)
 
-    print(json.loads(response.text))
-    return json.loads(response.text)
+    return yadle_json.decode(response, echo_level=1)
 
-def get_all_aggregates(file_id, server, bearer, app_id):
+def get_all_aggregates(file_id, server, bearer, app_id, client=None):
     # get all aggregates associated with a file
     url = "{0}/yadle/v2/file/{1}/aggregate/_all".format(server, file_id)
 
@@ -115,12 +129,11 @@ def get_all_aggregates(file_id, server, bearer, app_id):
         'Content-Type': 'application/json'
     }
 
-    response = requests.request("GET", url, headers=headers)
+    response = yadle_client.request("GET", url, headers=headers, client=client)
 
-    print(json.loads(response.text))
-    return json.loads(response.text)
+    return yadle_json.decode(response, echo_level=1)
 
-def edit_primary_file(file_id, aggregate_id, new_primary, server, bearer, app_id):
+def edit_primary_file(file_id, aggregate_id, new_primary, server, bearer, app_id, client=None, index=None):
     # edit primary file of an aggregate. The new primary file must already 
     # be a member of the aggregate.
     url = "{0}/yadle/v2/file/{1}/aggregate/{2}/edit_primary".format(server, file_id, aggregate_id)
@@ -133,12 +146,16 @@ def edit_primary_file(file_id, aggregate_id, new_primary, server, bearer, app_id
         'Content-Type': 'application/json'
     }
 
-    response = requests.request("PATCH", url, headers=headers, json=body)
+    response = yadle_client.request("PATCH", url, headers=headers, json=body, client=client)
+
+    res = yadle_json.decode(response, echo_level=1)
 
-    print(json.loads(response.text))
-    return json.loads(response.text)
+    if index is not None and res.get('code') == 200:
+        index.set_head(aggregate_id, new_primary)
 
-def delete_entire_aggregate(file_id, aggregate_id, server, bearer, app_id):
+    return res
+
+def delete_entire_aggregate(file_id, aggregate_id, server, bearer, app_id, client=None, index=None):
     # Delete an entire aggregate. Note: this does not affect any constituent files themselves.
     url = "{0}/yadle/v2/file/{1}/aggregate/{2}/entire".format(server, file_id, aggregate_id)
     
@@ -148,10 +165,177 @@ def delete_entire_aggregate(file_id, aggregate_id, server, bearer, app_id):
         'Content-Type': 'application/json'
     }
 
-    response = requests.request("DELETE", url, headers=headers)
-
-    print(json.loads(response.text))
-    return json.loads(response.text)
+    response = yadle_client.request("DELETE", url, headers=headers, client=client)
+
+    res = yadle_json.decode(response, echo_level=1)
+
+    if index is not None and 'error' not in res:
+        index.remove_aggregate(aggregate_id)
+
+    return res
+
+def coalesce_operations(ops):
+    """
+    Drop operations on one aggregate that cancel out or are overridden.
+
+    ops is a list of tuples: ('create', [members]), ('add', [files]),
+    ('remove', [files]), ('edit_primary', file_id) and ('delete',).
+
+    - Within a run of add/remove operations only the last action per file is
+      kept, except that a remove followed by an add of the same file
+      disappears: the file is a member either way.
+    - Adds and removes right after a create are folded into the create, where
+      the members are known, so an add followed by a remove disappears too.
+    - Of consecutive edit_primary operations only the last is kept.
+    - Everything before a delete is dropped, and if the aggregate is created
+      in the same list, nothing is sent at all.
+    """
+    for i in range(len(ops) - 1, -1, -1):
+        if ops[i][0] == 'delete':
+            if any(op[0] == 'create' for op in ops[:i]):
+                return []
+            return [('delete',)]
+
+    result = []
+    changes = []
+
+    def flush():
+        # Net effect of a run of adds and removes: file -> (first action, last action)
+        net = {}
+        for action, files in changes:
+            for f in files:
+                first = net[f][0] if f in net else action
+                net[f] = (first, action)
+        del changes[:]
+
+        removes = [f for f, (first, last) in net.items() if last == 'remove']
+
+        if result and result[-1][0] == 'create':
+            adds = [f for f, (first, last) in net.items() if last == 'add']
+            members = [f for f in result[-1][1] if f not in removes]
+            members += [f for f in adds if f not in members]
+            result[-1] = ('create', members)
+            return
+
+        # The current members are not known here, so an add followed by a remove
+        # still has to remove a file that may have been a member already.
+        adds = [f for f, (first, last) in net.items() if last == 'add' and first != 'remove']
+
+        if removes:
+            result.append(('remove', removes))
+        if adds:
+            result.append(('add', adds))
+
+    for op in ops:
+        if op[0] in ('add', 'remove'):
+            changes.append((op[0], list(op[1])))
+            continue
+
+        flush()
+        if op[0] == 'edit_primary' and result and result[-1][0] == 'edit_primary':
+            result[-1] = op
+        else:
+            result.append(op)
+
+    flush()
+    return result
+
+def manifest_operations(entry):
+    # The operation list of one manifest entry, before coalescing.
+    ops = []
+    if not entry.get('aggregate_id'):
+        if 'members' not in entry:
+            raise ValueError("manifest entry for {0} has neither aggregate_id nor members".format(entry.get('head')))
+        ops.append(('create', list(entry['members'])))
+
+    for op in entry.get('ops', []):
+        if op['op'] == 'delete':
+            ops.append(('delete',))
+        elif op['op'] == 'edit_primary':
+            ops.append(('edit_primary', op['file']))
+        elif op['op'] in ('add', 'remove'):
+            ops.append((op['op'], list(op['files'])))
+        else:
+            raise ValueError("unknown manifest operation: {0}".format(op['op']))
+
+    if entry.get('primary') and entry['primary'] != entry['head']:
+        ops.append(('edit_primary', entry['primary']))
+
+    if entry.get('delete'):
+        ops.append(('delete',))
+
+    return ops
+
+def apply_operations(head, aggregate_id, ops, server, bearer, app_id, client=None, index=None):
+    # Run the operations of one aggregate in order, stopping at the first error.
+    result = { 'head': head, 'aggregate_id': aggregate_id, 'responses': [], 'error': None }
+
+    for op in ops:
+        if op[0] not in ('create', 'remove', 'add', 'edit_primary', 'delete'):
+            raise ValueError("unknown aggregate operation: {0}".format(op[0]))
+        if op[0] != 'create' and not result['aggregate_id']:
+            result['error'] = { 'error': "no aggregate_id for {0}".format(op[0]) }
+            break
+
+        if op[0] == 'create':
+            response = create_aggregate(head, op[1], server, bearer, app_id, client=client, index=index)
+            result['aggregate_id'] = response.get('aggregate_id')
+        elif op[0] == 'remove':
+            response = remove_aggregate_members(head, result['aggregate_id'], op[1], server, bearer, app_id, client=client, index=index)
+        elif op[0] == 'add':
+            response = add_additional_aggregate_members(head, result['aggregate_id'], op[1], server, bearer, app_id, client=client, index=index)
+        elif op[0] == 'edit_primary':
+            response = edit_primary_file(head, result['aggregate_id'], op[1], server, bearer, app_id, client=client, index=index)
+            if response.get('code') == 200:
+                head = result['head'] = op[1]
+        elif op[0] == 'delete':
+            response = delete_entire_aggregate(head, result['aggregate_id'], server, bearer, app_id, client=client, index=index)
+
+        result['responses'].append((op[0], response))
+
+        if 'error' in response or (op[0] == 'create' and not result['aggregate_id']):
+            result['error'] = response
+            break
+
+    return result
+
+def run_manifest(manifest, server, bearer, app_id, workers=8, client=None, index=None):
+    """
+    Apply a manifest of aggregates concurrently.
+
+    Each entry is a dict with:
+        head          (required) file id the aggregate is attached to
+        aggregate_id  (optional) id of an existing aggregate; without it one is created
+        members       (required without aggregate_id) member file ids to create the aggregate with
+        primary       (optional) file id that should end up as the primary file
+        ops           (optional) further operations in order, each one of
+                      {"op": "add" | "remove", "files": [...]},
+                      {"op": "edit_primary", "file": ...} or {"op": "delete"}
+        delete        (optional) true to delete the aggregate at the end
+
+    The operations of an entry are applied in that order: create, ops, primary,
+    delete. Up to `workers` aggregates are processed at the same time. Yields one result
+    dict per entry, in manifest order; an entry that is not valid fails
+    with an error result before anything is sent. Pass a yadle_aggregate_index.AggregateIndex
+    as index to keep it up to date with the changes made.
+    """
+    def run(entry):
+        try:
+            ops = coalesce_operations(manifest_operations(entry))
+        except (ValueError, KeyError) as e:
+            return { 'head': entry.get('head'), 'aggregate_id': entry.get('aggregate_id'), 'responses': [],
+                     'error': { 'error': "invalid manifest entry: {0}".format(e) } }
+        return apply_operations(entry['head'], entry.get('aggregate_id'), ops, server, bearer, app_id,
+                                client=client, index=index)
+
+    return yadle_client.bounded_map(run, manifest, workers)
+
+def read_manifest(path):
+    # Manifest entries from a JSON list or a JSONL file.
+    with open(path) as f:
+        if path.endswith('.jsonl'):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
 
 
 def main():
@@ -0,0 +1,495 @@
+""" Offline benchmarks of the example modules against yadle_mock_server.
+
+    Starts a MockYadleServer in this process (or uses the one given with
+    --apiserver, e.g. one started with `python yadle_mock_server.py`) and times
+    the functions of yadle_search.py, getusers.py, adduser.py,
+    aggregate_methods.py and collection_methods.py against it. For each one it
+    reports:
+
+        calls      how many times the function was called
+        requests   how many API requests the server received meanwhile
+        req/s      requests per second of wall time
+        p50, p99   latency of one call, in milliseconds
+        errors     calls that raised, or answered with an error
+        peak RSS   peak resident memory of this process so far, in MB
+
+    --save writes the results as JSON. --compare reads such a file from an
+    earlier run and exits with status 1 if any benchmark's req/s dropped, or its
+    p99 grew, by more than --tolerance (a fraction), so a regression shows up
+    before it reaches a real job.
+
+    --startup instead checks the command line startup cost: how much longer
+    than a bare interpreter `python <script> --help` takes for each of the
+    example scripts, and that importing them does not import requests (which
+    is deferred until the first API call). It exits with status 1 if any script
+    goes over --startupbudget milliseconds.
+
+    Example:
+
+        python benchmark.py --calls 500 --latency 0.005 --save baseline.json
+        python benchmark.py --calls 500 --latency 0.005 --compare baseline.json
+        python benchmark.py --startup --startupbudget 50
+"""
+
+import argparse
+import io
+import json
+import math
+import os
+import resource
+import subprocess
+import sys
+import time
+
+# Never read or write the real bearer cache.
+os.environ['YADLE_TOKEN_CACHE'] = ''
+
+import requests
+
+import adduser
+import aggregate_methods
+import collection_methods
+import getusers
+import yadle_file_cache
+import yadle_json
+import yadle_mock_server
+import yadle_search
+
+
+APPID = 'benchmark-app'
+ORG = 'mock'
+DEVICE = 'device1'
+
+BENCHMARKS = []
+
+STARTUP_SCRIPTS = ['yadle_search.py', 'getusers.py', 'adduser.py', 'yadle_batch.py']
+
+# Modules that must not be imported until they are needed.
+DEFERRED_MODULES = ['requests', 'argparse', 'csv', 'pprint']
+
+
+def benchmark(name):
+    # Register a benchmark; they run in the order they are defined.
+    def register(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return register
+
+
+def percentile(values, p):
+    # Nearest-rank percentile of a sorted list.
+    if not values:
+        return 0.0
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def is_error(result):
+    return isinstance(result, dict) and 'error' in result
+
+
+class Run(object):
+    """ State shared by the benchmarks of one run. """
+
+    def __init__(self, apiserver, calls, args):
+        self.apiserver = apiserver
+        self.calls = calls
+        self.args = args
+        self.bearer = None
+        self.aggregates = []    # (head, aggregate_id) created by the create_aggregate benchmark
+        self.latencies = []
+        self.errors = 0
+
+    def server_requests(self):
+        return requests.get(self.apiserver + '/_mock/stats').json()['requests']
+
+    def timed(self, func, *args, **kwargs):
+        # Call func once, recording its latency and whether it failed.
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            result = None
+            self.errors += 1
+        else:
+            if is_error(result):
+                self.errors += 1
+        self.latencies.append(time.perf_counter() - start)
+        return result
+
+    def measure(self, name, func):
+        self.latencies = []
+        self.errors = 0
+        before = self.server_requests()
+        start = time.perf_counter()
+        func(self)
+        elapsed = time.perf_counter() - start
+        # The stats request itself is not counted by the server.
+        count = self.server_requests() - before
+
+        latencies = sorted(self.latencies)
+        return {
+            'name': name,
+            'calls': len(latencies),
+            'requests': count,
+            'seconds': elapsed,
+            'rps': count / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'errors': self.errors,
+            'peak_rss_mb': peak_rss_mb()
+        }
+
+
+# yadle_search.py
+
+@benchmark('yadle_search.logIn')
+def bench_login(run):
+    for _ in range(run.calls):
+        run.bearer = run.timed(yadle_search.logIn, run.apiserver, 'benchmark', 'password') or run.bearer
+
+@benchmark('yadle_search.search')
+def bench_search(run):
+    for i in range(run.calls):
+        run.timed(yadle_search.search, run.bearer, APPID, run.apiserver, (i * 100) % run.args.hits, 100, None, 'red car')
+
+@benchmark('yadle_search.stream_search')
+def bench_stream_search(run):
+    for i in range(run.calls):
+        run.timed(lambda: list(yadle_search.stream_search(run.bearer, APPID, run.apiserver,
+                                                          (i * 100) % run.args.hits, 100, None, 'red car')))
+
+@benchmark('yadle_search.iter_search')
+def bench_iter_search(run):
+    run.timed(lambda: sum(1 for _ in yadle_search.iter_search(run.bearer, APPID, run.apiserver, 'red car', page_size=100)))
+
+@benchmark('yadle_search.parallel_search')
+def bench_parallel_search(run):
+    run.timed(lambda: sum(1 for _ in yadle_search.parallel_search(run.bearer, APPID, run.apiserver, 'red car', window=100)))
+
+@benchmark('yadle_search.search_and_hydrate')
+def bench_search_and_hydrate(run):
+    file_cache = yadle_file_cache.FileDocCache()
+    for i in range(run.calls // 10 or 1):
+        run.timed(yadle_search.search_and_hydrate, run.bearer, APPID, run.apiserver, (i * 50) % run.args.hits, 50,
+                  'red car', file_cache)
+
+@benchmark('yadle_search.batch_search')
+def bench_batch_search(run):
+    # Every query appears twice, in a different spelling, once as a terms line and once as a json line.
+    lines = []
+    for i in range(run.calls):
+        if i % 2:
+            lines.append(json.dumps({'terms': ' "car  {0}"  "honda" '.format(i // 2), 'skip': 0, 'limit': 20}))
+        else:
+            lines.append('"car {0}" honda'.format(i // 2))
+    queries = yadle_search.read_queries(lines, skip=0, limit=20)
+    run.timed(yadle_search.batch_search, run.bearer, APPID, run.apiserver, queries, io.StringIO())
+
+
+# getusers.py
+
+@benchmark('getusers.getUsers')
+def bench_get_users(run):
+    for i in range(run.calls):
+        run.timed(getusers.getUsers, run.bearer, APPID, run.apiserver, (i * 100) % run.args.users, 100)
+
+@benchmark('getusers.streamUsers')
+def bench_stream_users(run):
+    for i in range(run.calls):
+        run.timed(lambda: list(getusers.streamUsers(run.bearer, APPID, run.apiserver, (i * 100) % run.args.users, 100)))
+
+@benchmark('getusers.exportUsers')
+def bench_export_users(run):
+    run.timed(getusers.exportUsers, run.bearer, APPID, run.apiserver, io.StringIO(), pageSize=100)
+
+
+# adduser.py
+
+@benchmark('adduser.addUser')
+def bench_add_user(run):
+    for i in range(run.calls):
+        run.timed(adduser.addUser, run.bearer, APPID, run.apiserver, 'new{0}@example.com'.format(i), 'New', 'User')
+
+@benchmark('adduser.addUsers')
+def bench_add_users(run):
+    invites = [{'email': 'new{0}@example.com'.format(i), 'firstname': 'New', 'lastname': 'User'}
+               for i in range(run.calls)]
+    run.timed(adduser.addUsers, run.bearer, APPID, run.apiserver, invites)
+
+
+# aggregate_methods.py
+
+def file_id(run, i):
+    return 'file{0:07d}'.format(i % run.args.files)
+
+@benchmark('aggregate_methods.get_file_info')
+def bench_get_file_info(run):
+    for i in range(run.calls):
+        run.timed(aggregate_methods.get_file_info, file_id(run, i), run.apiserver, run.bearer, APPID)
+
+@benchmark('aggregate_methods.create_aggregate')
+def bench_create_aggregate(run):
+    run.aggregates = []
+    for i in range(run.calls):
+        head = file_id(run, i * 4)
+        members = [file_id(run, i * 4 + 1), file_id(run, i * 4 + 2)]
+        res = run.timed(aggregate_methods.create_aggregate, head, members, run.apiserver, run.bearer, APPID)
+        if res and res.get('aggregate_id'):
+            run.aggregates.append((head, res['aggregate_id']))
+
+@benchmark('aggregate_methods.get_aggregate')
+def bench_get_aggregate(run):
+    for head, aggregate_id in run.aggregates:
+        run.timed(aggregate_methods.get_aggregate, head, aggregate_id, run.apiserver, run.bearer, APPID)
+
+@benchmark('aggregate_methods.get_all_aggregates')
+def bench_get_all_aggregates(run):
+    for head, aggregate_id in run.aggregates:
+        run.timed(aggregate_methods.get_all_aggregates, head, run.apiserver, run.bearer, APPID)
+
+@benchmark('aggregate_methods.add_additional_aggregate_members')
+def bench_add_aggregate_members(run):
+    for head, aggregate_id in run.aggregates:
+        run.timed(aggregate_methods.add_additional_aggregate_members, head, aggregate_id, [file_id(run, 3)],
+                  run.apiserver, run.bearer, APPID)
+
+@benchmark('aggregate_methods.remove_aggregate_members')
+def bench_remove_aggregate_members(run):
+    for head, aggregate_id in run.aggregates:
+        run.timed(aggregate_methods.remove_aggregate_members, head, aggregate_id, [file_id(run, 3)],
+                  run.apiserver, run.bearer, APPID)
+
+@benchmark('aggregate_methods.edit_primary_file')
+def bench_edit_primary_file(run):
+    edited = []
+    for head, aggregate_id in run.aggregates:
+        new_head = aggregate_methods.get_aggregate(head, aggregate_id, run.apiserver, run.bearer, APPID)['members'][0]
+        res = run.timed(aggregate_methods.edit_primary_file, head, aggregate_id, new_head,
+                        run.apiserver, run.bearer, APPID)
+        edited.append((new_head if res and res.get('code') == 200 else head, aggregate_id))
+    run.aggregates = edited
+
+@benchmark('aggregate_methods.delete_entire_aggregate')
+def bench_delete_entire_aggregate(run):
+    for head, aggregate_id in run.aggregates:
+        run.timed(aggregate_methods.delete_entire_aggregate, head, aggregate_id, run.apiserver, run.bearer, APPID)
+
+@benchmark('aggregate_methods.run_manifest')
+def bench_run_manifest(run):
+    manifest = [{'head': file_id(run, i * 3), 'members': [file_id(run, i * 3 + 1)],
+                 'ops': [{'op': 'add', 'files': [file_id(run, i * 3 + 2)]}], 'delete': i % 2 == 0}
+                for i in range(run.calls)]
+    run.timed(lambda: list(aggregate_methods.run_manifest(manifest, run.apiserver, run.bearer, APPID)))
+
+
+# collection_methods.py
+
+def directory(run, i):
+    return '/data/dir{0}/'.format(i % run.args.dirs)
+
+@benchmark('collection_methods.get_file_instances_in_directory')
+def bench_files_in_directory(run):
+    for i in range(run.calls):
+        run.timed(collection_methods.get_file_instances_in_directory, DEVICE, directory(run, i), ORG,
+                  run.apiserver, run.bearer, APPID)
+
+@benchmark('collection_methods.stream_file_instances_in_tree')
+def bench_files_in_tree(run):
+    run.timed(lambda: list(collection_methods.stream_file_instances_in_tree(DEVICE, '/data/', ORG, run.apiserver,
+                                                                            run.bearer, APPID, page_size=100)))
+
+@benchmark('collection_methods.get_matching_file_instances')
+def bench_matching_file_instances(run):
+    files = collection_methods.get_file_instances_in_directory(DEVICE, directory(run, 0), ORG, run.apiserver,
+                                                               run.bearer, APPID)['rows']
+    run.timed(collection_methods.get_matching_file_instances, files, directory(run, 0), run.apiserver,
+              run.bearer, APPID)
+
+def collection_body(run, i):
+    path_i = i % run.args.files
+    return {file_id(run, i): {DEVICE: ['path{0}'.format(path_i)]}}
+
+@benchmark('collection_methods.create_collection')
+def bench_create_collection(run):
+    for i in range(run.calls):
+        run.timed(collection_methods.create_collection, 'benchmark{0}'.format(i), collection_body(run, i),
+                  run.apiserver, run.bearer, APPID)
+
+@benchmark('collection_methods.add_members_to_collection')
+def bench_add_collection_members(run):
+    for i in range(run.calls):
+        run.timed(collection_methods.add_members_to_collection, 'benchmark{0}'.format(i), collection_body(run, i + 1),
+                  run.apiserver, run.bearer, APPID)
+
+@benchmark('collection_methods.get_collection')
+def bench_get_collection(run):
+    for i in range(run.calls):
+        run.timed(collection_methods.get_collection, 'benchmark{0}'.format(i), run.apiserver, run.bearer, APPID)
+
+@benchmark('collection_methods.remove_members_from_collection')
+def bench_remove_collection_members(run):
+    for i in range(run.calls):
+        run.timed(collection_methods.remove_members_from_collection, 'benchmark{0}'.format(i),
+                  collection_body(run, i + 1), run.apiserver, run.bearer, APPID)
+
+@benchmark('collection_methods.rename_collection')
+def bench_rename_collection(run):
+    for i in range(run.calls):
+        run.timed(collection_methods.rename_collection, 'benchmark{0}'.format(i), 'renamed{0}'.format(i),
+                  run.apiserver, run.bearer, APPID)
+
+@benchmark('collection_methods.get_all_collections')
+def bench_get_all_collections(run):
+    for i in range(run.calls):
+        run.timed(collection_methods.get_all_collections, None, run.apiserver, run.bearer, APPID)
+
+@benchmark('collection_methods.delete_collection')
+def bench_delete_collection(run):
+    for i in range(run.calls):
+        run.timed(collection_methods.delete_collection, 'renamed{0}'.format(i), run.apiserver, run.bearer, APPID)
+
+@benchmark('collection_methods.build_collection_from_directory')
+def bench_build_collection(run):
+    run.timed(collection_methods.build_collection_from_directory, 'benchmark_tree', DEVICE, '/data/', ORG,
+              run.apiserver, run.bearer, APPID, batch_size=100, recursive=True)
+    collection_methods.delete_collection('benchmark_tree', run.apiserver, run.bearer, APPID)
+
+@benchmark('collection_methods.sync_collection')
+def bench_sync_collection(run):
+    desired = dict(item for i in range(run.calls) for item in collection_body(run, i).items())
+    run.timed(collection_methods.sync_collection, 'benchmark_sync', desired, run.apiserver, run.bearer, APPID)
+    desired = dict(item for i in range(run.calls // 2, run.calls + run.calls // 2) for item in collection_body(run, i).items())
+    run.timed(collection_methods.sync_collection, 'benchmark_sync', desired, run.apiserver, run.bearer, APPID)
+    collection_methods.delete_collection('benchmark_sync', run.apiserver, run.bearer, APPID)
+
+
+def run_benchmarks(apiserver, args, only=None):
+    run = Run(apiserver, args.calls, args)
+    run.bearer = yadle_search.logIn(apiserver, 'benchmark', 'password')
+
+    results = []
+    for name, func in BENCHMARKS:
+        if only and not any(pattern in name for pattern in only):
+            continue
+        results.append(run.measure(name, func))
+        print_result(results[-1])
+    return results
+
+
+def print_header():
+    print("{0:<52} {1:>7} {2:>8} {3:>9} {4:>9} {5:>9} {6:>6} {7:>9}".format(
+        'benchmark', 'calls', 'requests', 'req/s', 'p50 ms', 'p99 ms', 'errors', 'peak MB'))
+
+def print_result(result):
+    print("{name:<52} {calls:>7} {requests:>8} {rps:>9.1f} {p50_ms:>9.2f} {p99_ms:>9.2f} {errors:>6} {peak_rss_mb:>9.1f}".format(
+        **result))
+    sys.stdout.flush()
+
+
+def regressions(results, baseline, tolerance):
+    # Descriptions of the benchmarks that got slower than baseline by more than tolerance.
+    previous = dict((result['name'], result) for result in baseline)
+    found = []
+    for result in results:
+        before = previous.get(result['name'])
+        if before is None:
+            continue
+        if result['rps'] < before['rps'] * (1 - tolerance):
+            found.append("{0}: {1:.1f} req/s, was {2:.1f}".format(result['name'], result['rps'], before['rps']))
+        if result['p99_ms'] > before['p99_ms'] * (1 + tolerance):
+            found.append("{0}: p99 {1:.2f} ms, was {2:.2f}".format(result['name'], result['p99_ms'], before['p99_ms']))
+    return found
+
+
+def wall_time(argv, runs):
+    # Median wall time of running argv, in seconds.
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True,
+                       cwd=os.path.dirname(os.path.abspath(__file__)))
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def check_startup(budget_ms, runs=11):
+    """ Print the startup overhead of each script; returns the list of problems found. """
+    problems = []
+    bare = wall_time([sys.executable, '-c', 'pass'], runs)
+    print("{0:<20} {1:>9} {2:>9}".format('script', 'total ms', 'extra ms'))
+    print("{0:<20} {1:>9.1f} {2:>9}".format('(python)', bare * 1000, ''))
+
+    for script in STARTUP_SCRIPTS:
+        total = wall_time([sys.executable, script, '--help'], runs)
+        extra = (total - bare) * 1000
+        print("{0:<20} {1:>9.1f} {2:>9.1f}".format(script, total * 1000, extra))
+        if extra > budget_ms:
+            problems.append("{0} --help takes {1:.1f} ms more than python, budget {2} ms".format(script, extra, budget_ms))
+
+        module = script[:-3]
+        code = "import sys, {0}; print(' '.join(m for m in {1!r} if m in sys.modules))".format(module, DEFERRED_MODULES)
+        loaded = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True, universal_newlines=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+        if loaded:
+            problems.append("importing {0} imports {1}".format(module, ', '.join(loaded)))
+
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--apiserver", required=False, help="a running yadle_mock_server; by default one is started")
+    parser.add_argument("--calls", required=False, type=int, default=200, help="calls per benchmark")
+    parser.add_argument("--only", required=False, action='append', help="run benchmarks whose name contains this")
+    parser.add_argument("--save", required=False, help="write the results to this JSON file")
+    parser.add_argument("--compare", required=False, help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", required=False, type=float, default=0.25)
+    parser.add_argument("--startup", required=False, action='store_true', help="check script startup time instead")
+    parser.add_argument("--startupbudget", required=False, type=float, default=50.0,
+                        help="milliseconds a script may add to interpreter startup")
+    yadle_mock_server.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    if args.startup:
+        problems = check_startup(args.startupbudget)
+        for line in problems:
+            print('STARTUP: ' + line)
+        sys.exit(1 if problems else 0)
+
+    yadle_json.set_verbosity(0)
+
+    server = None
+    apiserver = args.apiserver
+    if apiserver is None:
+        server = yadle_mock_server.MockYadleServer(**yadle_mock_server.options(args)).start()
+        apiserver = server.url
+
+    try:
+        print_header()
+        results = run_benchmarks(apiserver, args, args.only)
+    finally:
+        if server is not None:
+            server.stop()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print('REGRESSION: ' + line)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,33 +8,40 @@
     Than, just for the sake of example, it removes a few files, adds one file back to the collection,
     renames the collection, and finally, deletes the collection.
 
+    For large directories, build_collection_from_directory() does the same listing,
+    lookup and upload as a pipeline, sending the files in batches as they are found.
+    To refresh an existing collection, sync_collection() sends only the members that changed.
+
     See https://api.yadle.com/ for full documentation of the Yadle API.
 """
 
-import requests
-import json
+import yadle_auth
+import yadle_client
+import yadle_json
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 
-def logIn(apiserver, username, password):
-    url = "{0}/yadle/v2/auth/login".format(apiserver)
-    payload = "username={0}&password={1}&undefined=".format(username, password)
-    headers = {
-        'Content-Type': "application/x-www-form-urlencoded",
-        }
+def logIn(apiserver, username, password, client=None):
+    # Reuses a bearer cached by an earlier run when there is one (see yadle_auth.py).
+    return yadle_auth.logIn(apiserver, username, password, client=client)
+
+# Sorts after any character that can appear in a path, so a range from
+# prefix to prefix + KEY_RANGE_END covers every key that starts with prefix.
+KEY_RANGE_END = '\ufff0'
 
-    response = requests.request("POST", url, data=payload, headers=headers)
- 
-    # get Bearer
-    res = json.loads(response.text)
-    bearer = "Bearer {0}:{1}".format(res['token'], res['password'])
-    return bearer
+def path_to_id_view_url(org, server):
+    view_name = org + '_catalog'
 
-def get_file_instances_in_directory(device_id, directory, org, server, bearer, app_id):
+    return server + '/yadle/v2/utility/view/' + view_name + '/_design/path_to_id/_view/path_to_id3'
+
+def get_file_instances_in_directory(device_id, directory, org, server, bearer, app_id, client=None, recursive=False):
+    # With recursive=True, files in all subdirectories of directory are included too.
     try:
-        device_path = device_id + '_' + directory
+        if recursive:
+            return { 'rows': list(stream_file_instances_in_tree(device_id, directory, org, server, bearer, app_id, client=client)) }
 
-        view_name = org + '_catalog'
+        device_path = device_id + '_' + directory
 
         headers = {
             'authorization': bearer,
@@ -43,27 +50,92 @@ def get_file_instances_in_directory(device_id, directory, org, server, bearer, a
 
         querystring = { 'key': device_path, 'reduce': 'false' }
 
-        url = server + '/yadle/v2/utility/view/' + view_name + '/_design/path_to_id/_view/path_to_id3'
+        url = path_to_id_view_url(org, server)
 
-        response = requests.request("GET", url, headers = headers, params = querystring)
+        response = yadle_client.request("GET", url, headers = headers, params = querystring, client=client)
 
-        print('INFO: get_indexed_file_list_in_directory: ' + url + ' querystring: ' + str(querystring))
+        yadle_json.echo(querystring, prefix='INFO: get_indexed_file_list_in_directory: ' + url + ' querystring: ')
 
         if not response:
             print('INFO: Invalid response ' + url + ' ' + str(response))
             return response.text
 
-        response_json = response.json()
-        print('INFO: response_json: ' + str(response_json))
-
-        return response_json
+        return yadle_json.decode(response, echo_level=1, prefix='INFO: response_json: ')
 
     except:
         print('ERROR: ' + traceback.format_exc())
         return None
 
-def get_file_info(file_id, server, bearer, app_id):
-    
+def stream_file_instances_in_directory(device_id, directory, org, server, bearer, app_id, client=None, recursive=False):
+    # Same query as get_file_instances_in_directory(), but yields the view rows
+    # one at a time as they are decoded from the socket.
+    if recursive:
+        return stream_file_instances_in_tree(device_id, directory, org, server, bearer, app_id, client=client)
+
+    headers = {
+        'authorization': bearer,
+        'x-app-id': app_id
+    }
+
+    querystring = { 'key': device_id + '_' + directory, 'reduce': 'false' }
+
+    response = yadle_client.request("GET", path_to_id_view_url(org, server), headers = headers,
+                                    params = querystring, client=client, stream=True)
+    response.raise_for_status()
+
+    return yadle_json.iter_rows(response)
+
+def stream_file_instances_in_tree(device_id, directory, org, server, bearer, app_id, page_size=1000, client=None):
+    """
+    Yield the view rows of the files in directory and in all of its subdirectories.
+
+    Rather than one exact key query per subdirectory, this scans the key range
+    of every device_id_directory... key in pages of page_size rows. Each page
+    starts after the last row of the previous one. A file with instances in
+    several subdirectories is only yielded once.
+    """
+    device_path = device_id + '_' + directory
+
+    headers = {
+        'authorization': bearer,
+        'x-app-id': app_id
+    }
+
+    querystring = {
+        'startkey': device_path,
+        'endkey': device_path + KEY_RANGE_END,
+        'reduce': 'false',
+        'limit': page_size
+    }
+
+    url = path_to_id_view_url(org, server)
+    seen = set()
+
+    while True:
+        response = yadle_client.request("GET", url, headers = headers, params = querystring, client=client, stream=True)
+        response.raise_for_status()
+
+        count = 0
+        last_row = None
+        for row in yadle_json.iter_rows(response):
+            count += 1
+            last_row = row
+            if row['id'] not in seen:
+                seen.add(row['id'])
+                yield row
+
+        if count < page_size:
+            return
+
+        querystring['startkey'] = last_row['key']
+        querystring['startkey_docid'] = last_row['id']
+        querystring['skip'] = 1
+
+def get_file_info(file_id, server, bearer, app_id, client=None, cache=None):
+    # Pass a yadle_file_cache.FileDocCache as cache to reuse documents fetched earlier.
+    if cache is not None:
+        return cache.get_file_info(file_id, server, bearer, app_id, client=client)
+
     url = "{0}/yadle/v2/file/{1}".format(server, file_id)
     payload = ""
     headers = {
@@ -72,44 +144,70 @@ def get_file_info(file_id, server, bearer, app_id):
         'cache-control': "no-cache"
         }
 
-    response = requests.request("GET", url, data=payload, headers=headers)
+    response = yadle_client.request("GET", url, data=payload, headers=headers, client=client)
 
     if not response:
         print('ERROR: ' + url + ' returns a null response ' + str(response))
-        print(str(json.loads(response.text)))
+        print(str(yadle_json.decode(response)))
         return None
 
-    return json.loads(response.text)
+    return yadle_json.decode(response)
 
-def get_matching_file_instances(files, collection_dir, server, bearer, app_id):
+def get_matching_file_instances(files, collection_dir, server, bearer, app_id, client=None, workers=8, cache=None, recursive=False,
+                                catalog=None, max_age=None):
     """
     Because Yadle tracks any and all copies of a file, we need to make sure we're only 
     using instances of a file that are in the given directory. This function iterates
     over all instances of a file and returns only the instances that are in the
     given directory (collection_dir).
+
+    The file documents are fetched concurrently, with at most `workers` requests
+    in flight at a time. Use workers=1 to fetch them one after another.
+    Pass a yadle_file_cache.FileDocCache as cache to skip documents already fetched.
+    With recursive=True, instances in subdirectories of collection_dir match as well.
+
+    Pass a yadle_catalog.Catalog as catalog to answer from the local mirror
+    instead; only files it does not have yet (or has had for longer than
+    max_age seconds) are fetched, to bring it up to date first.
     """
+    if catalog is not None:
+        file_ids = [file_info['id'] for file_info in files]
+        fetch = lambda file_id: get_file_info(file_id, server, bearer, app_id, client=client, cache=cache)
+        catalog.sync(file_ids, fetch, max_age=max_age, workers=workers)
+        return catalog.matching_file_instances(file_ids, collection_dir, recursive)
+
+    def hydrate(file_info):
+        yadle_json.echo(file_info)
+        return file_info, get_file_info(file_info['id'], server, bearer, app_id, client=client, cache=cache)
+
     files_to_add = {}
-    for file_info in files:
-        print(file_info)
-        file_doc = get_file_info(file_info['id'], server, bearer, app_id)
+    for file_info, file_doc in yadle_client.bounded_map(hydrate, files, workers):
 
-        for device_id in file_doc['device']:
+        for device_id, path_ids in matching_instances(file_doc, collection_dir, recursive).items():
+            files_to_add.setdefault(file_info['id'], {}).setdefault(device_id, []).extend(path_ids)
 
-            for path_id in file_doc['device'][device_id]['files']:
+    return files_to_add
 
-                if file_doc['device'][device_id]['files'][path_id]['dir'] == collection_dir:
-                    if file_info['id'] not in files_to_add:
-                        files_to_add[file_info['id']] = {}
+def matching_instances(file_doc, collection_dir, recursive=False):
+    # The {device_id: [path_id]} instances of one file document that are in collection_dir
+    # (or, if recursive, anywhere below it). collection_dir must end with a slash.
+    instances = {}
+    for device_id in file_doc['device']:
 
-                    if device_id not in files_to_add[file_info['id']]:
-                        files_to_add[file_info['id']][device_id] = []
+        for path_id in file_doc['device'][device_id]['files']:
 
-                    files_to_add[file_info['id']][device_id].append(path_id)
+            path_dir = file_doc['device'][device_id]['files'][path_id]['dir']
 
-    return files_to_add
+            if path_dir == collection_dir or (recursive and path_dir.startswith(collection_dir)):
+                if device_id not in instances:
+                    instances[device_id] = []
+
+                instances[device_id].append(path_id)
+
+    return instances
 
 
-def create_collection(collection_name, body, server, bearer, app_id):
+def create_collection(collection_name, body, server, bearer, app_id, client=None):
 
     """ The http message body when using creating or updating a collection 
     should look like this:
@@ -133,13 +231,12 @@ def create_collection(collection_name, body, server, bearer, app_id):
     'Content-Type': 'application/json'
     }
 
-    response = requests.request("POST", url, headers=headers, json=body)
+    response = yadle_client.request("POST", url, headers=headers, json=body, client=client)
 
-    print(json.loads(response.text))
-    return json.loads(response.text)
+    return yadle_json.decode(response, echo_level=1)
 
-def get_collection(collection_name, server, bearer, app_id):
-    # Get collection documents
+def collection_request(collection_name, server, bearer, app_id, client=None):
+    # Send the get_collection() request and return the undecoded response.
     url = "{0}/yadle/v2/collection/{1}".format(server, collection_name)
 
     headers = {
@@ -148,12 +245,15 @@ def get_collection(collection_name, server, bearer, app_id):
         'Content-Type': 'application/json'
     }
 
-    response = requests.request("GET", url, headers=headers)
+    return yadle_client.request("GET", url, headers=headers, client=client)
+
+def get_collection(collection_name, server, bearer, app_id, client=None):
+    # Get collection documents
+    response = collection_request(collection_name, server, bearer, app_id, client=client)
 
-    print(json.loads(response.text))
-    return json.loads(response.text)
+    return yadle_json.decode(response, echo_level=1)
 
-def get_all_collections(collection_name, server, bearer, app_id):
+def get_all_collections(collection_name, server, bearer, app_id, client=None):
     # Get collection documents
     url = "{0}/yadle/v2/collection/_all".format(server, collection_name)
 
@@ -163,11 +263,11 @@ def get_all_collections(collection_name, server, bearer, app_id):
         'Content-Type': 'application/json'
     }
 
-    response = requests.request("GET", url, headers=headers)
+    response = yadle_client.request("GET", url, headers=headers, client=client)
 
-    return json.loads(response.text)
+    return yadle_json.decode(response)
 
-def remove_members_from_collection(collection_name, body, server, bearer, app_id):
+def remove_members_from_collection(collection_name, body, server, bearer, app_id, client=None):
     # Delete files from a collection
     url = "{0}/yadle/v2/collection/{1}".format(server, collection_name)
 
@@ -177,12 +277,11 @@ def remove_members_from_collection(collection_name, body, server, bearer, app_id
     'Content-Type': 'application/json'
     }
 
-    response = requests.request("DELETE", url, headers=headers, json=body)
+    response = yadle_client.request("DELETE", url, headers=headers, json=body, client=client)
 
-    print(json.loads(response.text))
-    return json.loads(response.text)
+    return yadle_json.decode(response, echo_level=1)
 
-def add_members_to_collection(collection_name, body, server, bearer, app_id):
+def add_members_to_collection(collection_name, body, server, bearer, app_id, client=None):
     # Add files to a collection
     url = "{0}/yadle/v2/collection/{1}".format(server, collection_name)
 
@@ -192,12 +291,11 @@ def add_members_to_collection(collection_name, body, server, bearer, app_id):
     'Content-Type': 'application/json'
     }
 
-    response = requests.request("PATCH", url, headers=headers, json=body)
+    response = yadle_client.request("PATCH", url, headers=headers, json=body, client=client)
 
-    print(json.loads(response.text))
-    return json.loads(response.text)
+    return yadle_json.decode(response, echo_level=1)
 
-def rename_collection(collection_name, new_name, server, bearer, app_id):
+def rename_collection(collection_name, new_name, server, bearer, app_id, client=None):
     # Rename collection
     url = "{0}/yadle/v2/collection/{1}/new_name/{2}".format(server, collection_name, new_name)
 
@@ -207,11 +305,11 @@ def rename_collection(collection_name, new_name, server, bearer, app_id):
         'Content-Type': 'application/json'
     }
 
-    response = requests.request('PATCH', url, headers=headers)
+    response = yadle_client.request('PATCH', url, headers=headers, client=client)
 
-    print(json.loads(response.text))
+    yadle_json.decode(response, echo_level=1)
 
-def delete_collection(collection_name, server, bearer, app_id):
+def delete_collection(collection_name, server, bearer, app_id, client=None):
     # Delete collection
     url = "{0}/yadle/v2/collection/{1}/entire".format(server, collection_name)
 
@@ -221,12 +319,164 @@ def delete_collection(collection_name, server, bearer, app_id):
         'Content-Type': 'application/json'
     }
 
-    response = requests.request('DELETE', url, headers=headers)
+    response = yadle_client.request('DELETE', url, headers=headers, client=client)
 
-    print(json.loads(response.text))
-    return json.loads(response.text)
+    return yadle_json.decode(response, echo_level=1)
 
 
+def build_collection_from_directory(collection_name, device_id, collection_dir, org, server, bearer, app_id,
+                                    batch_size=500, workers=8, client=None, cache=None, recursive=False):
+    """
+    Pipelined version of what main() does below: list a directory, look up the
+    matching instances of each file and put them in a collection.
+
+    Instead of loading everything first and sending one large create_collection
+    request, the collection is created from the first batch_size files and each
+    later batch is sent with add_members_to_collection while the next batch is
+    still being looked up. Only about two batches are held in memory at a time.
+
+    With recursive=True the whole directory tree under collection_dir is included.
+
+    Returns the number of files added, or None if an upload failed or a file
+    could not be looked up; no further batches are sent after either.
+    """
+    files = stream_file_instances_in_directory(device_id, collection_dir, org, server, bearer, app_id,
+                                               client=client, recursive=recursive)
+
+    def hydrate(file_info):
+        return file_info['id'], get_file_info(file_info['id'], server, bearer, app_id, client=client, cache=cache)
+
+    def upload(batch, first):
+        if first:
+            return create_collection(collection_name, batch, server, bearer, app_id, client=client)
+        return add_members_to_collection(collection_name, batch, server, bearer, app_id, client=client)
+
+    def failed(uploading):
+        return uploading is not None and 'error' in uploading.result()
+
+    # One upload thread, so batches reach the server in order and the create comes first.
+    uploader = ThreadPoolExecutor(max_workers=1)
+    uploading = None
+    batch = {}
+    added = 0
+    hydrated = yadle_client.bounded_map(hydrate, files, workers)
+
+    try:
+        for file_id, file_doc in hydrated:
+            if file_doc is None:
+                print('error looking up file ' + file_id + ' for collection ' + collection_name)
+                return None
+
+            for instance_device_id, path_ids in matching_instances(file_doc, collection_dir, recursive).items():
+                batch.setdefault(file_id, {}).setdefault(instance_device_id, []).extend(path_ids)
+
+            if len(batch) >= batch_size:
+                # Wait for the previous batch first, so at most one is uploading
+                # while the next one is being looked up.
+                if failed(uploading):
+                    break
+                uploading = uploader.submit(upload, batch, uploading is None)
+                added += len(batch)
+                batch = {}
+
+        if (batch or uploading is None) and not failed(uploading):
+            uploading = uploader.submit(upload, batch, uploading is None)
+            added += len(batch)
+
+        if failed(uploading):
+            print('error uploading to collection ' + collection_name)
+            return None
+    finally:
+        hydrated.close()
+        files.close()
+        uploader.shutdown()
+
+    return added
+
+def collection_members(collection_doc):
+    # The {file_id: {device_id: [path_id]}} members of a get_collection() response.
+    # Raises ValueError if the response does not look like a collection.
+    if not isinstance(collection_doc, dict):
+        raise ValueError("unrecognized collection document: {0!r}".format(collection_doc))
+
+    for key in ('files', 'members'):
+        if isinstance(collection_doc.get(key), dict):
+            return collection_doc[key]
+
+    members = dict((file_id, devices) for file_id, devices in collection_doc.items()
+                   if isinstance(devices, dict) and all(isinstance(paths, list) for paths in devices.values()))
+    if collection_doc and not members:
+        raise ValueError("unrecognized collection document with keys: {0}".format(', '.join(sorted(collection_doc))))
+    return members
+
+def flatten_members(members):
+    # {file_id: {device_id: [path_id]}} -> set of (file_id, device_id, path_id)
+    return set((file_id, device_id, path_id)
+               for file_id, devices in members.items()
+               for device_id, path_ids in devices.items()
+               for path_id in path_ids)
+
+def member_batches(instances, batch_size):
+    # Group (file_id, device_id, path_id) instances back into request bodies of at most batch_size files.
+    body = {}
+    for file_id, device_id, path_id in sorted(instances):
+        if file_id not in body and len(body) >= batch_size:
+            yield body
+            body = {}
+        body.setdefault(file_id, {}).setdefault(device_id, []).append(path_id)
+    if body:
+        yield body
+
+def sync_collection(collection_name, desired, server, bearer, app_id, batch_size=500, client=None):
+    """
+    Make a collection contain exactly the desired {file_id: {device_id: [path_id]}}
+    members, sending only what changed.
+
+    The current members are read with get_collection() and compared instance by
+    instance with desired; only the instances to remove and the instances to add
+    are sent, in batches of batch_size files. A collection that does not exist
+    (404) yet is created. Returns {'added': n, 'removed': n}, counted in
+    instances. If a request fails the sync stops there and the result also has
+    'error' set to the failed response; the counts are what was done until then.
+
+    Raises requests.HTTPError if reading the collection fails with anything
+    other than a 404, and ValueError if its members cannot be recognized.
+    """
+    response = collection_request(collection_name, server, bearer, app_id, client=client)
+    desired_instances = flatten_members(desired)
+    result = { 'added': 0, 'removed': 0 }
+
+    def send(request, body, count):
+        res = request(collection_name, body, server, bearer, app_id, client=client)
+        if not isinstance(res, dict) or 'error' in res:
+            result['error'] = res
+            return False
+        result[count] += len(flatten_members(body))
+        return True
+
+    if response.status_code == 404:
+        batches = list(member_batches(desired_instances, batch_size)) or [{}]
+        if send(create_collection, batches[0], 'added'):
+            for body in batches[1:]:
+                if not send(add_members_to_collection, body, 'added'):
+                    break
+        return result
+
+    response.raise_for_status()
+    current = yadle_json.decode(response, echo_level=1)
+
+    current_instances = flatten_members(collection_members(current))
+    to_remove = current_instances - desired_instances
+    to_add = desired_instances - current_instances
+
+    for request, instances, count in ((remove_members_from_collection, to_remove, 'removed'),
+                                      (add_members_to_collection, to_add, 'added')):
+        for body in member_batches(instances, batch_size):
+            if not send(request, body, count):
+                return result
+
+    return result
+
 
 def main():
     
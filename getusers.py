@@ -44,6 +44,13 @@
 #         	skip=20 and limit=20, you would be given results 21-40,
 #         	because it would skip the first 20 users and would give you the next 20
 #
+# streamUsers() takes the same arguments as getUsers() but returns a generator
+# that decodes the user rows one at a time as the response arrives.
+#
+# exportUsers() pages through all users with skip/limit, fetching several
+# pages at a time, and writes each row to a file as CSV or JSONL as soon as
+# its page arrives, so memory use does not grow with the number of users.
+#
 #
 # Command line usage:
 # While the code below can be used as a module, it can also be launched from the command line.
@@ -56,6 +63,10 @@
 # The following arguments are optional:
 #   --skip
 #   --limit
+#   --export		csv or jsonl: export all users instead of printing them
+#   --output		file to export to (default stdout)
+#   --pagesize		users per page when exporting (default 500)
+#   --workers		pages fetched at the same time when exporting (default 4)
 #
 #   Example usage:
 #	python getusers.py \
@@ -65,33 +76,32 @@
 #		--appid="api_xxxxxxxxxxxxxxxxxxxx" \
 #		--limit=5 \
 #		--skip=2
+#
+#	python getusers.py \
+#		--apiserver="https://yadle11.yadle.com" \
+#		--user=yadle \
+#		--password=xxxxxxx \
+#		--appid="api_xxxxxxxxxxxxxxxxxxxx" \
+#		--export=csv \
+#		--output=users.csv
 
 
 
-import requests
+import yadle_auth
+import yadle_client
+import yadle_json
+import sys
+import itertools
 import json
-import pprint
-import traceback, sys
-import argparse
-
 
 
-def logIn(apiserver, username, password):
-    url = "{0}/yadle/v2/auth/login".format(apiserver)
-    payload = "username={0}&password={1}&undefined=".format(username, password)
-    headers = {
-        'Content-Type': "application/x-www-form-urlencoded",
-        }
 
-    response = requests.request("POST", url, data=payload, headers=headers)
+def logIn(apiserver, username, password, client=None):
+    # Reuses a bearer cached by an earlier run when there is one (see yadle_auth.py).
+    return yadle_auth.logIn(apiserver, username, password, client=client)
 
-    # get Bearer
-    res = json.loads(response.text)
-    bearer = "Bearer {0}:{1}".format(res['token'], res['password'])
-    return bearer
 
-
-def getUsers(bearer, appid, apiserver, skip, limit):
+def usersRequest(bearer, appid, apiserver, skip, limit, client=None, stream=False):
 	skipString = ""
 	limitString = ""
 	quietString = ""
@@ -110,20 +120,77 @@ def getUsers(bearer, appid, apiserver, skip, limit):
 		'cache-control': "no-cache"
 	}
 
-	response = requests.request("GET", url, headers=headers)
-	users = json.loads(response.text)
+	return yadle_client.request("GET", url, headers=headers, client=client, stream=stream)
+
+
+def streamUsers(bearer, appid, apiserver, skip, limit, client=None):
+	# Yield the user rows one at a time as they are decoded from the socket.
+	response = usersRequest(bearer, appid, apiserver, skip, limit, client=client, stream=True)
+	response.raise_for_status()
+
+	return yadle_json.iter_rows(response)
+
+
+def getUsers(bearer, appid, apiserver, skip, limit, client=None):
+	response = usersRequest(bearer, appid, apiserver, skip, limit, client=client)
+	users = yadle_json.decode(response)
 
-	for u in users['rows']:
-		print(u['id'],u['firstName'],u['lastName'], u['status'])
+	if yadle_json.verbosity >= 1:
+		for u in users['rows']:
+			print(u['id'],u['firstName'],u['lastName'], u['status'])
 
 
-	#pprint.pprint(users)
+	#yadle_json.echo(users, pretty=True)
 
 	return users
 
 
+CSV_FIELDS = ['id', 'firstName', 'lastName', 'status']
+
+
+def iterAllUsers(bearer, appid, apiserver, pageSize=500, workers=4, client=None):
+	# Yield every user, fetching up to `workers` pages at a time. Stops after the first short page.
+	# A page that fails raises requests.HTTPError, so an error is never taken for the last page.
+	def fetchPage(skip):
+		return list(streamUsers(bearer, appid, apiserver, skip, pageSize, client=client))
+
+	pages = yadle_client.bounded_map(fetchPage, itertools.count(0, pageSize), workers)
+	try:
+		for page in pages:
+			for u in page:
+				yield u
+
+			if len(page) < pageSize:
+				return
+	finally:
+		pages.close()
+
+
+def exportUsers(bearer, appid, apiserver, out, format='csv', pageSize=500, workers=4, client=None):
+	# Write all users to the file object `out` as CSV or JSONL. Returns the number of users written.
+	if format == 'csv':
+		import csv
+		writer = csv.DictWriter(out, fieldnames=CSV_FIELDS, extrasaction='ignore')
+		writer.writeheader()
+		write = writer.writerow
+	elif format == 'jsonl':
+		write = lambda u: out.write(json.dumps(u) + '\n')
+	else:
+		raise ValueError("unknown export format: {0}".format(format))
+
+	count = 0
+	for u in iterAllUsers(bearer, appid, apiserver, pageSize=pageSize, workers=workers, client=client):
+		write(u)
+		count += 1
+
+	out.flush()
+	return count
+
+
 
 def main():
+	import argparse
+
 	parser = argparse.ArgumentParser()
 	parser.add_argument("--apiserver", required=True)
 	parser.add_argument("--user", required=True)
@@ -131,12 +198,32 @@ def main():
 	parser.add_argument("--appid", required=True)
 	parser.add_argument("--skip", required=False)
 	parser.add_argument("--limit", required=False)
+	parser.add_argument("--export", required=False, choices=['csv', 'jsonl'])
+	parser.add_argument("--output", required=False)
+	parser.add_argument("--pagesize", required=False, type=int, default=500)
+	parser.add_argument("--workers", required=False, type=int, default=4)
 
 	args = parser.parse_args()
 
 	# log in and get the bearer that will be used to authenticate for subsequent API calls.
 	bearer = logIn(args.apiserver, args.user, args.password)
 
+	if args.export is not None:
+		out = open(args.output, 'w', newline='') if args.output else sys.stdout
+		try:
+			exportUsers(
+				bearer=bearer,
+				appid=args.appid,
+				apiserver=args.apiserver,
+				out=out,
+				format=args.export,
+				pageSize=args.pagesize,
+				workers=args.workers)
+		finally:
+			if out is not sys.stdout:
+				out.close()
+		return
+
 
 	# get list of users
 	#
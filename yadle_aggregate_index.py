@@ -0,0 +1,167 @@
+""" Local index of which files belong to which aggregates.
+
+    An AggregateIndex answers "which aggregates is this file in" and "which
+    files are in this aggregate" from memory, instead of one get_all_aggregates()
+    call per file.
+
+    build() fills it concurrently from get_all_aggregates() responses. After
+    that, pass it as the index= argument of the aggregate functions in
+    aggregate_methods.py (create_aggregate(), remove_aggregate_members(),
+    add_additional_aggregate_members(), edit_primary_file(),
+    delete_entire_aggregate() and run_manifest()) and it is updated as they
+    succeed. save() and load() keep it on disk between runs.
+
+    Example:
+
+        index = AggregateIndex.load('aggregates.json')
+        index.build(file_ids, server, bearer, app_id)
+        index.save('aggregates.json')
+        index.aggregates_of('file_id1')
+"""
+
+import json
+import os
+import threading
+
+import aggregate_methods
+import yadle_client
+
+
+def aggregates_in_response(response):
+    """ (aggregate_id, primary, [member file ids]) for each aggregate in a get_all_aggregates() response.
+
+        Accepts a list of aggregate documents, or a dict holding one under
+        'aggregates', 'rows' or 'docs', or a dict of aggregate id -> document.
+    """
+    if isinstance(response, list):
+        items = response
+    elif isinstance(response, dict):
+        for key in ('aggregates', 'rows', 'docs'):
+            if isinstance(response.get(key), list):
+                items = response[key]
+                break
+        else:
+            items = [dict(doc, aggregate_id=aggregate_id) for aggregate_id, doc in response.items()
+                     if isinstance(doc, dict)]
+    else:
+        items = []
+
+    result = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        if isinstance(item.get('value'), dict):
+            item = dict(item['value'], aggregate_id=item.get('id'))
+
+        aggregate_id = item.get('aggregate_id') or item.get('_id') or item.get('id')
+        if not aggregate_id:
+            continue
+
+        members = item.get('members') or item.get('files') or []
+        primary = item.get('primary') or item.get('primary_file') or item.get('head')
+        result.append((aggregate_id, primary, list(members)))
+
+    return result
+
+
+class AggregateIndex(object):
+
+    def __init__(self):
+        self.members = {}       # aggregate id -> set of file ids
+        self.heads = {}         # aggregate id -> primary file id
+        self.files = {}         # file id -> set of aggregate ids
+        self._lock = threading.Lock()
+
+    # lookups
+
+    def aggregates_of(self, file_id):
+        return self.files.get(file_id, frozenset())
+
+    def members_of(self, aggregate_id):
+        return self.members.get(aggregate_id, frozenset())
+
+    def head_of(self, aggregate_id):
+        return self.heads.get(aggregate_id)
+
+    # updates
+
+    def set_aggregate(self, aggregate_id, head, members):
+        with self._lock:
+            self._drop(aggregate_id)
+            members = set(members)
+            if head:
+                members.add(head)
+                self.heads[aggregate_id] = head
+            self.members[aggregate_id] = members
+            for file_id in members:
+                self.files.setdefault(file_id, set()).add(aggregate_id)
+
+    def add_members(self, aggregate_id, file_ids):
+        with self._lock:
+            members = self.members.setdefault(aggregate_id, set())
+            for file_id in file_ids:
+                members.add(file_id)
+                self.files.setdefault(file_id, set()).add(aggregate_id)
+
+    def remove_members(self, aggregate_id, file_ids):
+        with self._lock:
+            members = self.members.get(aggregate_id, set())
+            for file_id in file_ids:
+                members.discard(file_id)
+                self._unlink(file_id, aggregate_id)
+
+    def set_head(self, aggregate_id, head):
+        with self._lock:
+            self.heads[aggregate_id] = head
+            self.members.setdefault(aggregate_id, set()).add(head)
+            self.files.setdefault(head, set()).add(aggregate_id)
+
+    def remove_aggregate(self, aggregate_id):
+        with self._lock:
+            self._drop(aggregate_id)
+
+    def _unlink(self, file_id, aggregate_id):
+        aggregates = self.files.get(file_id)
+        if aggregates is not None:
+            aggregates.discard(aggregate_id)
+            if not aggregates:
+                del self.files[file_id]
+
+    def _drop(self, aggregate_id):
+        # Caller holds the lock.
+        for file_id in self.members.pop(aggregate_id, ()):
+            self._unlink(file_id, aggregate_id)
+        self.heads.pop(aggregate_id, None)
+
+    # building and persistence
+
+    def build(self, file_ids, server, bearer, app_id, workers=8, client=None):
+        """ Index the aggregates of every file in file_ids, fetching up to `workers` at a time. """
+        def fetch(file_id):
+            return aggregate_methods.get_all_aggregates(file_id, server, bearer, app_id, client=client)
+
+        count = 0
+        for response in yadle_client.bounded_map(fetch, file_ids, workers):
+            for aggregate_id, primary, members in aggregates_in_response(response):
+                self.set_aggregate(aggregate_id, primary, members)
+                count += 1
+        return count
+
+    def save(self, path):
+        with self._lock:
+            data = dict((aggregate_id, {'head': self.heads.get(aggregate_id), 'members': sorted(members)})
+                        for aggregate_id, members in self.members.items())
+
+        tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        if os.path.exists(path):
+            with open(path) as f:
+                for aggregate_id, entry in json.load(f).items():
+                    index.set_aggregate(aggregate_id, entry.get('head'), entry.get('members', []))
+        return index
@@ -0,0 +1,172 @@
+""" Log in to Yadle and cache the bearer between runs.
+
+    logIn() returns the same "Bearer token:password" string as the logIn()
+    function in each example module, but it first looks for a bearer cached on
+    disk for the same apiserver and user. Only when there is none does it do the
+    /yadle/v2/auth/login round trip, and the new bearer is saved for next time.
+
+    The cache is a json file, by default ~/.yadle/bearer_cache.json. Set the
+    YADLE_TOKEN_CACHE environment variable to use another file, or set it to an
+    empty string to turn the cache off. The file is created readable by the
+    current user only, since anyone holding a bearer can use the API as you.
+    Bearers from a login replayed by a yadle_cassette are never saved, since
+    they are placeholders.
+
+    When the server rejects a bearer (401), yadle_client.request() calls
+    relogin() which drops the cached entry, logs in again with the credentials
+    the bearer was issued for and retries the request with the new bearer.
+"""
+
+import json
+import os
+import threading
+import time
+
+import yadle_cassette
+import yadle_client
+import yadle_json
+
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.yadle', 'bearer_cache.json')
+
+_lock = threading.RLock()
+
+# bearer -> (apiserver, username, password) for every bearer handed out by logIn()
+_credentials = {}
+
+# rejected bearer -> the bearer that replaced it, so concurrent callers
+# holding the same stale bearer only trigger one login.
+_replaced = {}
+
+
+class LoginError(Exception):
+    pass
+
+
+def cache_path():
+    return os.environ.get('YADLE_TOKEN_CACHE', DEFAULT_CACHE_PATH)
+
+
+def _cache_key(apiserver, username):
+    return "{0}|{1}".format(apiserver.rstrip('/'), username)
+
+
+def _read_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _write_cache(path, cache):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+
+    tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(cache, f)
+    os.chmod(tmp_path, 0o600)
+    os.replace(tmp_path, path)
+
+
+def cached_bearer(apiserver, username):
+    path = cache_path()
+    if not path:
+        return None
+
+    with _lock:
+        entry = _read_cache(path).get(_cache_key(apiserver, username))
+
+    if entry:
+        return entry.get('bearer')
+    return None
+
+
+def save_bearer(apiserver, username, bearer):
+    path = cache_path()
+    if not path:
+        return
+
+    with _lock:
+        cache = _read_cache(path)
+        cache[_cache_key(apiserver, username)] = {'bearer': bearer, 'created': int(time.time())}
+        _write_cache(path, cache)
+
+
+def forget_bearer(apiserver, username):
+    path = cache_path()
+    if not path:
+        return
+
+    with _lock:
+        cache = _read_cache(path)
+        if cache.pop(_cache_key(apiserver, username), None) is not None:
+            _write_cache(path, cache)
+
+
+def login_request(apiserver, username, password, client=None):
+    # The actual /auth/login round trip, bypassing the cache.
+    url = "{0}/yadle/v2/auth/login".format(apiserver)
+    payload = "username={0}&password={1}&undefined=".format(username, password)
+    headers = {
+        'Content-Type': "application/x-www-form-urlencoded",
+        }
+
+    response = yadle_client.request("POST", url, data=payload, headers=headers, client=client)
+
+    # get Bearer
+    res = yadle_json.decode(response)
+    if 'token' not in res or 'password' not in res:
+        raise LoginError("login to {0} as {1} failed: {2}".format(apiserver, username, res))
+
+    return "Bearer {0}:{1}".format(res['token'], res['password'])
+
+
+def logIn(apiserver, username, password, client=None, use_cache=True):
+    bearer = None
+    if use_cache:
+        bearer = cached_bearer(apiserver, username)
+
+    if bearer is None:
+        bearer = login_request(apiserver, username, password, client=client)
+        if use_cache and not yadle_cassette.replaying(client):
+            save_bearer(apiserver, username, bearer)
+
+    with _lock:
+        _credentials[bearer] = (apiserver, username, password)
+
+    return bearer
+
+
+def current_bearer(bearer):
+    # Follow the chain of replacements made by relogin().
+    while bearer in _replaced:
+        bearer = _replaced[bearer]
+    return bearer
+
+
+def relogin(bearer, client=None):
+    """ Replace a bearer the server rejected.
+
+        Returns the new bearer, or None if the bearer was not issued by logIn()
+        in this process and so there are no credentials to log in again with.
+    """
+    with _lock:
+        if bearer in _replaced:
+            return current_bearer(bearer)
+
+        credentials = _credentials.get(bearer)
+        if credentials is None:
+            return None
+
+        apiserver, username, password = credentials
+        forget_bearer(apiserver, username)
+        new_bearer = logIn(apiserver, username, password, client=client)
+        if new_bearer == bearer:
+            return None
+        _replaced[bearer] = new_bearer
+
+    return new_bearer
@@ -0,0 +1,361 @@
+""" Run a stream of Yadle API operations in one warm process.
+
+    Instead of starting yadle_search.py, getusers.py or adduser.py once per
+    call, send the calls to this script as JSON lines. It logs in once, keeps
+    one pooled YadleClient for all of them and runs up to --workers operations
+    at a time. Each input line is one operation:
+
+        {"op": "search", "args": {"terms": "red car", "skip": 0, "limit": 20}, "id": "q1"}
+        {"op": "create_aggregate", "args": {"file_id": "f1", "member_list": ["f2", "f3"]}}
+        {"op": "add_members_to_collection", "args": {"collection_name": "c1", "body": {...}}}
+
+    `args` are the arguments of the function of the same name in the example
+    modules, without the server, bearer, app id and client; see OPERATIONS
+    below for the list. "manifest_entry" takes one aggregate_methods.run_manifest()
+    entry as its args, to create an aggregate and change it in the same batch.
+    `id` is optional and is copied to the output.
+
+    Operations on the same object run in input order, one after another: the
+    same aggregate or file (head or member) for the aggregate calls, the same
+    collection (including both names of a rename), the same email for addUser.
+    An operation may also name extra objects to order by in "key" (a string or
+    a list). Everything else runs concurrently. A failed operation does not
+    stop the ones after it.
+
+    For each operation one JSON line is written as it finishes (so not
+    necessarily in input order):
+
+        {"line": 3, "id": "q1", "op": "search", "ok": true, "result": {...}}
+        {"line": 4, "op": "get_aggregate", "ok": false, "error": "..."}
+
+    An operation fails when it raises, returns an 'error' or returns nothing
+    (as get_file_info() does when the file cannot be read). Anything the
+    example functions print goes to stderr, so stdout only carries results.
+
+    Example:
+
+        python yadle_batch.py --apiserver https://example1.yadle.com --user u --password p \\
+            --appid your_app_id --org yadle1 --input ops.jsonl --output results.jsonl
+"""
+
+import json
+import sys
+import threading
+import traceback
+
+import adduser
+import aggregate_methods
+import collection_methods
+import getusers
+import yadle_client
+import yadle_json
+import yadle_search
+
+
+class Runner(object):
+    """ Login and connection state shared by all operations. """
+
+    def __init__(self, apiserver, appid, org=None, workers=8):
+        self.apiserver = apiserver
+        self.appid = appid
+        self.org = org
+        self.client = yadle_client.YadleClient(apiserver, appid, pool_maxsize=max(workers, yadle_client.DEFAULT_POOL_MAXSIZE))
+        self.bearer = None
+
+    def login(self, username, password):
+        self.bearer = self.client.login(username, password)
+        return self.bearer
+
+    def server_args(self):
+        # The trailing arguments of the aggregate_methods and collection_methods functions.
+        return {'server': self.apiserver, 'bearer': self.bearer, 'app_id': self.appid, 'client': self.client}
+
+
+OPERATIONS = {}
+
+
+def operation(name, keys=None):
+    # Register an operation; keys(args) names the objects it must be ordered by.
+    def register(func):
+        OPERATIONS[name] = (func, keys or (lambda args: []))
+        return func
+    return register
+
+
+def _file_keys(args):
+    # The file, the aggregate and every file whose membership the call changes.
+    keys = ['file:' + args['file_id']]
+    if args.get('aggregate_id'):
+        keys.append('aggregate:' + args['aggregate_id'])
+    if args.get('new_primary'):
+        keys.append('file:' + args['new_primary'])
+    for name in ('member_list', 'files_to_add', 'members_to_remove'):
+        keys += ['file:' + file_id for file_id in args.get(name) or []]
+    return keys
+
+def _manifest_keys(entry):
+    files = [entry['head'], entry.get('primary')] + list(entry.get('members') or [])
+    for op in entry.get('ops', []):
+        files += list(op.get('files') or []) + [op.get('file')]
+    keys = ['file:' + file_id for file_id in files if file_id]
+    if entry.get('aggregate_id'):
+        keys.append('aggregate:' + entry['aggregate_id'])
+    return keys
+
+def _collection_keys(args):
+    keys = ['collection:' + args['collection_name']]
+    if args.get('new_name'):
+        keys.append('collection:' + args['new_name'])
+    return keys
+
+
+# yadle_search.py
+
+@operation('search')
+def run_search(runner, args):
+    return yadle_search.search_page(runner.bearer, runner.appid, runner.apiserver, args.get('skip', 0),
+                                    args.get('limit', 20), args.get('quiet'), args['terms'], client=runner.client)[1]
+
+
+# getusers.py
+
+@operation('getUsers')
+def run_get_users(runner, args):
+    return getusers.getUsers(runner.bearer, runner.appid, runner.apiserver, args.get('skip'), args.get('limit'),
+                             client=runner.client)
+
+
+# adduser.py
+
+@operation('addUser', lambda args: ['user:' + args['email'].lower()])
+def run_add_user(runner, args):
+    response = adduser.inviteRequest(runner.bearer, runner.appid, runner.apiserver, args['email'],
+                                     args.get('firstname', ''), args.get('lastname', ''), client=runner.client)
+    return {'status': response.status_code}
+
+
+# aggregate_methods.py and collection_methods.py; args are passed through as keyword arguments.
+
+def _passthrough(module, name, keys):
+    func = getattr(module, name)
+
+    def run(runner, args):
+        kwargs = dict(args)
+        kwargs.update(runner.server_args())
+        return func(**kwargs)
+
+    operation(name, keys)(run)
+
+
+for _name in ('get_file_info', 'create_aggregate', 'get_aggregate', 'get_all_aggregates',
+              'add_additional_aggregate_members', 'remove_aggregate_members', 'edit_primary_file',
+              'delete_entire_aggregate'):
+    _passthrough(aggregate_methods, _name, _file_keys)
+
+for _name in ('create_collection', 'get_collection', 'add_members_to_collection', 'remove_members_from_collection',
+              'rename_collection', 'delete_collection', 'sync_collection'):
+    _passthrough(collection_methods, _name, _collection_keys)
+
+@operation('manifest_entry', _manifest_keys)
+def run_manifest_entry(runner, args):
+    # One aggregate_methods.run_manifest() entry, e.g. to create an aggregate and change it in the same batch.
+    ops = aggregate_methods.coalesce_operations(aggregate_methods.manifest_operations(args))
+    result = aggregate_methods.apply_operations(args['head'], args.get('aggregate_id'), ops, runner.apiserver,
+                                                runner.bearer, runner.appid, client=runner.client)
+    if result['error'] is None:
+        del result['error']
+    return result
+
+
+@operation('get_all_collections')
+def run_get_all_collections(runner, args):
+    return collection_methods.get_all_collections(None, runner.apiserver, runner.bearer, runner.appid,
+                                                  client=runner.client)
+
+@operation('build_collection_from_directory', _collection_keys)
+def run_build_collection(runner, args):
+    kwargs = dict(args)
+    kwargs.setdefault('org', runner.org)
+    kwargs.update(runner.server_args())
+    return collection_methods.build_collection_from_directory(**kwargs)
+
+
+class Task(object):
+
+    def __init__(self, line, request):
+        self.line = line
+        self.request = request
+        self.waiting = 0        # unfinished tasks this one must wait for
+        self.dependents = []    # tasks waiting for this one
+        self.keys = []
+
+
+class Scheduler(object):
+    """
+    Runs tasks on a thread pool, each one only after the earlier tasks that
+    share one of its keys have finished. At most max_pending tasks are queued
+    or running at a time; submit() blocks until there is room.
+    """
+
+    def __init__(self, execute, workers=8, max_pending=None):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.execute = execute
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.max_pending = max_pending or workers * 4
+        self.pending = 0
+        self.last = {}          # key -> most recent unfinished task with that key
+        self.cond = threading.Condition()
+
+    def submit(self, task, keys):
+        with self.cond:
+            # The oldest pending task never waits for anything, so this always drains.
+            while self.pending >= self.max_pending:
+                self.cond.wait()
+            self.pending += 1
+
+            task.keys = keys = list(dict.fromkeys(keys))
+            for key in keys:
+                previous = self.last.get(key)
+                if previous is not None and task not in previous.dependents:
+                    previous.dependents.append(task)
+                    task.waiting += 1
+                self.last[key] = task
+            ready = task.waiting == 0
+
+        if ready:
+            self.executor.submit(self._run, task)
+
+    def _run(self, task):
+        try:
+            self.execute(task)
+        finally:
+            ready = []
+            with self.cond:
+                for key in task.keys:
+                    if self.last.get(key) is task:
+                        del self.last[key]
+                for dependent in task.dependents:
+                    dependent.waiting -= 1
+                    if dependent.waiting == 0:
+                        ready.append(dependent)
+                self.pending -= 1
+                self.cond.notify_all()
+
+            for dependent in ready:
+                self.executor.submit(self._run, dependent)
+
+    def close(self):
+        # Wait until every submitted task has run.
+        with self.cond:
+            while self.pending:
+                self.cond.wait()
+        self.executor.shutdown(wait=True)
+
+
+def parse_operation(text):
+    # (request, keys) for one input line; raises ValueError if it is not a known operation.
+    request = json.loads(text)
+    if not isinstance(request, dict) or request.get('op') not in OPERATIONS:
+        raise ValueError("unknown operation: {0}".format(text.strip()))
+
+    args = request.setdefault('args', {})
+    keys = list(OPERATIONS[request['op']][1](args))
+    extra = request.get('key')
+    if extra:
+        keys += ['key:' + key for key in ([extra] if isinstance(extra, str) else extra)]
+    return request, keys
+
+
+def run_batch(runner, lines, out, workers=8):
+    """
+    Run the operations in lines (JSON text, one per line) and write one result
+    line per operation to out. Returns (succeeded, failed).
+    """
+    counts = {'ok': 0, 'failed': 0}
+    out_lock = threading.Lock()
+
+    def write(result):
+        text = json.dumps(result) + '\n'
+        with out_lock:
+            out.write(text)
+            out.flush()
+            counts['ok' if result['ok'] else 'failed'] += 1
+
+    def execute(task):
+        request = task.request
+        result = {'line': task.line, 'op': request['op']}
+        if 'id' in request:
+            result['id'] = request['id']
+
+        try:
+            res = OPERATIONS[request['op']][0](runner, request['args'])
+            result['ok'] = res is not None and not (isinstance(res, dict) and 'error' in res)
+            result['result'] = res
+            if res is None:
+                result['error'] = 'no result'
+        except Exception:
+            result['ok'] = False
+            result['error'] = traceback.format_exc(limit=1).strip()
+        write(result)
+
+    scheduler = Scheduler(execute, workers)
+    try:
+        for number, text in enumerate(lines, 1):
+            if not text.strip():
+                continue
+            try:
+                request, keys = parse_operation(text)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                write({'line': number, 'ok': False, 'error': str(e)})
+                continue
+            scheduler.submit(Task(number, request), keys)
+    finally:
+        scheduler.close()
+
+    return counts['ok'], counts['failed']
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--apiserver", required=True)
+    parser.add_argument("--user", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--appid", required=True)
+    parser.add_argument("--org", required=False, help="organization, for build_collection_from_directory")
+    parser.add_argument("--input", required=False, help="JSONL operations; default stdin")
+    parser.add_argument("--output", required=False, help="JSONL results; default stdout")
+    parser.add_argument("--workers", required=False, type=int, default=8)
+
+    args = parser.parse_args()
+
+    # stdout carries the results.
+    yadle_json.set_verbosity(0)
+
+    runner = Runner(args.apiserver, args.appid, args.org, args.workers)
+    runner.login(args.user, args.password)
+
+    lines = open(args.input) if args.input else sys.stdin
+    out = open(args.output, 'w') if args.output else sys.stdout
+
+    # The example functions print their diagnostics; keep them out of the results.
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    try:
+        succeeded, failed = run_batch(runner, lines, out, args.workers)
+    finally:
+        sys.stdout = stdout
+        if lines is not sys.stdin:
+            lines.close()
+        if out is not sys.stdout:
+            out.close()
+        runner.client.close()
+
+    sys.stderr.write("{0} operations succeeded, {1} failed\n".format(succeeded, failed))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
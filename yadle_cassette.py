@@ -0,0 +1,242 @@
+""" Record API exchanges to a cassette file and replay them offline.
+
+    In record mode every call sent through yadle_client.request() goes to the
+    server as usual, and its final response (after any retries) is appended to
+    the cassette together with how long it took. In replay mode the same calls
+    are answered from the cassette without touching the network, so a run can
+    be profiled for its client side cost alone: JSON decoding, the loops over
+    file documents, printing and so on.
+
+    A call matches a recorded one with the same verb, url (including the query
+    string) and request body. When the same call was recorded several times its
+    responses are replayed in the recorded order, the last one repeating. A
+    call that was never recorded raises CassetteError.
+
+    Replay waits `latency` times the recorded duration before answering: 1.0
+    reproduces the recorded timing, 0.0 (the default) answers at once. Timing
+    a run both ways shows how much of it is client overhead.
+
+    The cassette is a JSON lines file, gzip compressed if its name ends in .gz.
+    Request headers (and so bearers) are not stored, request bodies only as a
+    hash, and the token in login responses is replaced with a placeholder
+    (which yadle_auth does not save to its bearer cache).
+    Responses are read completely while recording, so streamed calls are not
+    streamed then.
+
+    Enable a cassette with use() or for a single YadleClient with
+    YadleClient(cassette=...), or for a whole run by setting YADLE_CASSETTE to
+    its path, YADLE_CASSETTE_MODE to record or replay (default replay) and
+    optionally YADLE_CASSETTE_LATENCY.
+
+    Example:
+
+        yadle_cassette.use('search.jsonl.gz', 'record')
+        search(bearer, appid, apiserver, 0, 100, None, terms)
+
+        yadle_cassette.use('search.jsonl.gz', 'replay', latency=0.0)
+        search(bearer, appid, apiserver, 0, 100, None, terms)
+"""
+
+import atexit
+import base64
+import json
+import os
+import threading
+import time
+from collections import deque
+
+
+# Response headers kept in the cassette.
+RECORDED_HEADERS = ('Content-Type', 'Content-Encoding', 'ETag', 'Retry-After', 'Location')
+
+# Placeholder stored instead of the secrets in a login response.
+REDACTED = 'cassette'
+
+
+class CassetteError(Exception):
+    pass
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def prepare(method, url, kwargs):
+    # The request as requests would send it, for its final url and body.
+    import requests
+
+    return requests.Request(method.upper(), url, params=kwargs.get('params'), data=kwargs.get('data'),
+                            json=kwargs.get('json')).prepare()
+
+
+def request_key(prepared):
+    import hashlib
+
+    body = prepared.body or b''
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return '{0} {1} {2}'.format(prepared.method, prepared.url, hashlib.sha1(body).hexdigest())
+
+
+def _redact(url, content):
+    # Keep login secrets out of the cassette.
+    if not url.split('?')[0].endswith('/auth/login'):
+        return content
+    try:
+        res = json.loads(content.decode('utf-8'))
+    except ValueError:
+        return content
+    if not isinstance(res, dict):
+        return content
+    for name in ('token', 'password'):
+        if name in res:
+            res[name] = REDACTED
+    return json.dumps(res).encode('utf-8')
+
+
+class Cassette(object):
+
+    def __init__(self, path, mode='replay', latency=0.0):
+        if mode not in ('record', 'replay'):
+            raise ValueError("unknown cassette mode: {0}".format(mode))
+
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.recorded = 0
+        self.replayed = 0
+        self._entries = {}      # request key -> deque of recorded responses
+        self._lock = threading.Lock()
+        self._file = None
+
+        if mode == 'replay':
+            self._load()
+        else:
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._file = _open(path, 'w')
+
+    def _load(self):
+        with _open(self.path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._entries.setdefault(entry['key'], deque()).append(entry)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def send(self, do_send, method, url, kwargs):
+        """ Answer one call, from the cassette or by calling do_send() and recording its response. """
+        prepared = prepare(method, url, kwargs)
+        key = request_key(prepared)
+
+        if self.mode == 'replay':
+            return self._replay(key, prepared)
+
+        start = time.perf_counter()
+        response = do_send()
+        seconds = time.perf_counter() - start
+        self._record(key, response, seconds)
+        return response
+
+    def _record(self, key, response, seconds):
+        content = _redact(response.url or '', response.content)
+        entry = {
+            'key': key,
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': dict((name, response.headers[name]) for name in RECORDED_HEADERS if name in response.headers),
+            'seconds': round(seconds, 6)
+        }
+        try:
+            entry['text'] = content.decode('utf-8')
+        except UnicodeDecodeError:
+            entry['base64'] = base64.b64encode(content).decode('ascii')
+
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self._lock:
+            if self._file is None:
+                raise CassetteError("cassette {0} is closed".format(self.path))
+            self._file.write(line)
+            self.recorded += 1
+
+    def _replay(self, key, prepared):
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                raise CassetteError("no recorded response for {0} {1} in {2}".format(
+                    prepared.method, prepared.url, self.path))
+            entry = entries.popleft() if len(entries) > 1 else entries[0]
+            self.replayed += 1
+
+        import requests
+        from requests.structures import CaseInsensitiveDict
+
+        if self.latency:
+            time.sleep(entry['seconds'] * self.latency)
+
+        if 'text' in entry:
+            content = entry['text'].encode('utf-8')
+        else:
+            content = base64.b64decode(entry['base64'])
+
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.reason = entry.get('reason')
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response.headers['Content-Length'] = str(len(content))
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = prepared.url
+        response.request = prepared
+        response._content = content
+        response._content_consumed = True
+        return response
+
+
+cassette = None
+
+
+def use(path, mode='replay', latency=0.0):
+    """ Record or replay all calls of this process with the cassette at path. """
+    global cassette
+    stop()
+    cassette = Cassette(path, mode, latency)
+    return cassette
+
+
+def stop():
+    global cassette
+    if cassette is not None:
+        cassette.close()
+        cassette = None
+
+
+def cassette_for(client=None):
+    # The Cassette for a call of client, or None when calls go to the network.
+    return getattr(client, 'cassette', None) or cassette
+
+
+def replaying(client=None):
+    # True when calls of client are answered from a cassette rather than the server.
+    current = cassette_for(client)
+    return current is not None and current.mode == 'replay'
+
+
+if os.environ.get('YADLE_CASSETTE'):
+    use(os.environ['YADLE_CASSETTE'], os.environ.get('YADLE_CASSETTE_MODE') or 'replay',
+        float(os.environ.get('YADLE_CASSETTE_LATENCY') or 0.0))
+    atexit.register(stop)
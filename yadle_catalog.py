@@ -0,0 +1,146 @@
+""" Local SQLite mirror of where Yadle files live.
+
+    A Catalog keeps the device/path/dir instances of file documents in an
+    indexed SQLite database, so questions like "which instances of these files
+    are in this directory on this device" are answered locally instead of with
+    one get_file_info() call per file.
+
+    sync() is incremental: it only fetches documents of files that are not in
+    the catalog yet, or whose copy is older than max_age seconds. Pass the
+    catalog as the catalog= argument of collection_methods.get_matching_file_instances()
+    to resolve collection membership through it.
+
+    Example:
+
+        catalog = Catalog('/var/tmp/yadle_catalog.db')
+        fetch = lambda file_id: get_file_info(file_id, server, bearer, app_id)
+        catalog.sync(file_ids, fetch, max_age=3600)
+        catalog.instances_in_dir('a_device_id', '/full/path/to/a/directory/')
+"""
+
+import sqlite3
+import time
+
+import yadle_client
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    file_id TEXT PRIMARY KEY,
+    synced REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS instances (
+    file_id TEXT NOT NULL,
+    device_id TEXT NOT NULL,
+    path_id TEXT NOT NULL,
+    dir TEXT NOT NULL,
+    PRIMARY KEY (file_id, device_id, path_id)
+);
+CREATE INDEX IF NOT EXISTS instances_by_dir ON instances (device_id, dir);
+CREATE INDEX IF NOT EXISTS instances_by_dir_only ON instances (dir);
+'''
+
+
+def _prefix_end(prefix):
+    # Smallest string greater than every string that starts with prefix.
+    return prefix + '\U0010ffff'
+
+
+class Catalog(object):
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def store(self, file_id, file_doc, synced=None):
+        """ Replace the instances recorded for one file with those in file_doc. """
+        rows = []
+        for device_id in file_doc.get('device', {}):
+            for path_id, path in file_doc['device'][device_id].get('files', {}).items():
+                rows.append((file_id, device_id, path_id, path['dir']))
+
+        with self.db:
+            self.db.execute("DELETE FROM instances WHERE file_id = ?", (file_id,))
+            self.db.executemany("INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?)", rows)
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?)",
+                            (file_id, time.time() if synced is None else synced))
+
+    def forget(self, file_id):
+        with self.db:
+            self.db.execute("DELETE FROM instances WHERE file_id = ?", (file_id,))
+            self.db.execute("DELETE FROM files WHERE file_id = ?", (file_id,))
+
+    def stale(self, file_ids, max_age=None):
+        """ The file ids that are missing from the catalog or older than max_age seconds. """
+        oldest = None if max_age is None else time.time() - max_age
+        result = []
+        for file_id in file_ids:
+            row = self.db.execute("SELECT synced FROM files WHERE file_id = ?", (file_id,)).fetchone()
+            if row is None or (oldest is not None and row[0] < oldest):
+                result.append(file_id)
+        return result
+
+    def sync(self, file_ids, fetch, max_age=None, workers=8):
+        """ Bring the given files up to date, fetching only the stale ones.
+
+            fetch(file_id) must return the file document, or None if it could
+            not be fetched; such files are left as they were. Returns the
+            number of documents fetched.
+        """
+        todo = self.stale(list(file_ids), max_age)
+
+        def fetch_one(file_id):
+            return file_id, fetch(file_id)
+
+        fetched = 0
+        for file_id, file_doc in yadle_client.bounded_map(fetch_one, todo, workers):
+            if file_doc is not None:
+                self.store(file_id, file_doc)
+                fetched += 1
+        return fetched
+
+    def instances_in_dir(self, device_id, directory, recursive=False):
+        """ (file_id, device_id, path_id, dir) of every instance in directory on device_id. """
+        if recursive:
+            cursor = self.db.execute(
+                "SELECT file_id, device_id, path_id, dir FROM instances "
+                "WHERE device_id = ? AND dir >= ? AND dir < ? ORDER BY dir, file_id",
+                (device_id, directory, _prefix_end(directory)))
+        else:
+            cursor = self.db.execute(
+                "SELECT file_id, device_id, path_id, dir FROM instances "
+                "WHERE device_id = ? AND dir = ? ORDER BY file_id",
+                (device_id, directory))
+        return cursor.fetchall()
+
+    def matching_file_instances(self, file_ids, collection_dir, recursive=False):
+        """ Same result as collection_methods.get_matching_file_instances(), from local data.
+
+            {file_id: {device_id: [path_id]}} of the instances of file_ids that
+            are in collection_dir on any device (or below it, if recursive).
+        """
+        if recursive:
+            condition = "dir >= ? AND dir < ?"
+            args = (collection_dir, _prefix_end(collection_dir))
+        else:
+            condition = "dir = ?"
+            args = (collection_dir,)
+
+        files_to_add = {}
+        for file_id in file_ids:
+            cursor = self.db.execute(
+                "SELECT device_id, path_id FROM instances WHERE file_id = ? AND " + condition + " ORDER BY rowid",
+                (file_id,) + args)
+            for device_id, path_id in cursor:
+                files_to_add.setdefault(file_id, {}).setdefault(device_id, []).append(path_id)
+        return files_to_add
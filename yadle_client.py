@@ -0,0 +1,262 @@
+""" Shared HTTP client for the Yadle API examples.
+
+    Every example module sends its requests through request() below instead of
+    calling requests.request() directly. That way all calls in a process share
+    keep-alive connections instead of paying a new TCP + TLS handshake per call.
+
+    A YadleClient holds the server url, app id and bearer together with its own
+    connection pool. Pass one as the client= argument of any example function
+    to run that function through it, or use its get/post/patch/delete methods
+    with a path relative to /yadle/v2.
+
+    If the server answers 401 to a bearer that came from yadle_auth.logIn(),
+    the request is retried once with a fresh bearer (see yadle_auth.py).
+    Throttling and transient errors are retried with backoff, and the number
+    of requests in flight adapts to how hard the server pushes back (see
+    yadle_retry.py).
+
+    With metrics enabled, the endpoint, status, latency, size and retries of
+    every call are recorded (see yadle_metrics.py). With a cassette in use,
+    calls are recorded to it or replayed from it (see yadle_cassette.py).
+
+    Example:
+
+        client = YadleClient('https://example1.yadle.com', 'your_app_id',
+                             bearer=logIn(server, username, password))
+        file_doc = get_file_info(file_id, server, bearer, app_id, client=client)
+"""
+
+from collections import deque
+from itertools import islice
+import threading
+import time
+
+import yadle_auth
+import yadle_cassette
+import yadle_metrics
+import yadle_retry
+
+
+API_PREFIX = "/yadle/v2"
+
+# Number of distinct hosts to keep pools for, and how many idle keep-alive
+# connections are kept per host. Raise pool_maxsize when running many
+# requests concurrently from threads.
+DEFAULT_POOL_CONNECTIONS = 4
+DEFAULT_POOL_MAXSIZE = 16
+
+
+def new_session(pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE):
+    # requests is imported here, when the first connection is needed, so that
+    # importing the examples (or running one with --help) stays fast.
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class YadleClient(object):
+
+    def __init__(self, apiserver, appid=None, bearer=None,
+                 pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 retry_policy=None, limiter=None, metrics=None, cassette=None):
+        self.apiserver = apiserver.rstrip('/')
+        self.appid = appid
+        self.bearer = bearer
+        self.session = new_session(pool_connections, pool_maxsize)
+
+        # None means the shared yadle_retry.policy and yadle_retry.limiter.
+        self.retry_policy = retry_policy
+        self.limiter = limiter
+
+        # None means the shared yadle_metrics.metrics, if enabled.
+        self.metrics = metrics
+
+        # None means the shared yadle_cassette.cassette, if one is in use.
+        self.cassette = cassette
+
+    def url(self, path):
+        if path.startswith('http://') or path.startswith('https://'):
+            return path
+        if not path.startswith('/yadle/'):
+            path = API_PREFIX + '/' + path.lstrip('/')
+        return self.apiserver + path
+
+    def headers(self, extra=None):
+        headers = {}
+        if self.appid is not None:
+            headers['x-app-id'] = self.appid
+        if self.bearer is not None:
+            headers['Authorization'] = self.bearer
+        if extra:
+            headers.update(extra)
+        return headers
+
+    def login(self, username, password):
+        self.bearer = yadle_auth.logIn(self.apiserver, username, password, client=self)
+        return self.bearer
+
+    def request(self, method, url, **kwargs):
+        return self.session.request(method, url, **kwargs)
+
+    def call(self, method, path, headers=None, **kwargs):
+        # Send a request to a path under /yadle/v2 with this client's app id and bearer.
+        return request(method, self.url(path), client=self, headers=self.headers(headers), **kwargs)
+
+    def get(self, path, **kwargs):
+        return self.call("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.call("POST", path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.call("PATCH", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.call("DELETE", path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_default_session = None
+
+
+def default_session():
+    # Process-wide pooled session used when no client is given.
+    global _default_session
+    if _default_session is None:
+        _default_session = new_session()
+    return _default_session
+
+
+def _send(method, url, client, kwargs):
+    if client is not None:
+        do_request = lambda: client.request(method, url, **kwargs)
+    else:
+        do_request = lambda: default_session().request(method, url, **kwargs)
+
+    recorder = yadle_metrics.recorder(client)
+    cassette = yadle_cassette.cassette_for(client)
+    if recorder is None and cassette is None:
+        return yadle_retry.send(do_request, method, client)
+
+    attempts = [0]
+
+    def counted_request():
+        attempts[0] += 1
+        return do_request()
+
+    def send_with_retries():
+        return yadle_retry.send(counted_request, method, client)
+
+    start = time.perf_counter()
+    try:
+        if cassette is not None:
+            response = cassette.send(send_with_retries, method, url, kwargs)
+        else:
+            response = send_with_retries()
+    except Exception:
+        if recorder is not None:
+            recorder.observe(method, url, None, time.perf_counter() - start, max(0, attempts[0] - 1))
+        raise
+
+    if recorder is not None:
+        recorder.observe(method, url, response, time.perf_counter() - start, max(0, attempts[0] - 1),
+                         stream=kwargs.get('stream', False))
+    return response
+
+
+def _with_bearer(headers, bearer):
+    headers = dict(headers)
+    for name in list(headers):
+        if name.lower() == 'authorization':
+            headers[name] = bearer
+    return headers
+
+
+def request(method, url, client=None, **kwargs):
+    """ Drop-in replacement for requests.request() used by the example modules. """
+    bearer = None
+    if kwargs.get('headers'):
+        headers = kwargs['headers']
+        bearer = headers.get('Authorization', headers.get('authorization'))
+
+        # A bearer that was already replaced after a 401 is swapped for its
+        # replacement up front rather than failing once per call.
+        current = yadle_auth.current_bearer(bearer)
+        if current != bearer:
+            kwargs['headers'] = headers = _with_bearer(headers, current)
+            bearer = current
+
+    response = _send(method, url, client, kwargs)
+
+    if response.status_code == 401 and bearer:
+        new_bearer = yadle_auth.relogin(bearer, client=client)
+
+        if new_bearer is not None:
+            if client is not None and client.bearer == bearer:
+                client.bearer = new_bearer
+            kwargs['headers'] = _with_bearer(headers, new_bearer)
+            response = _send(method, url, client, kwargs)
+
+    return response
+
+
+def bounded_map(func, items, workers=8):
+    """ Like map(), but runs func on a thread pool with at most `workers` calls in flight.
+
+        Results are yielded in the order of items. Only a couple of results per
+        worker are held at a time, so items can be a long or lazy iterable.
+    """
+    items = iter(items)
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = deque()
+
+    try:
+        for item in islice(items, workers * 2):
+            pending.append(executor.submit(func, item))
+
+        while pending:
+            result = pending.popleft().result()
+            for item in islice(items, 1):
+                pending.append(executor.submit(func, item))
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+class RateLimiter(object):
+    """ Spaces out calls from any number of threads to at most `rate` per second. """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            time.sleep(wait)
@@ -0,0 +1,148 @@
+""" Cache of Yadle file documents for get_file_info().
+
+    A FileDocCache keeps file documents in memory, in least recently used order,
+    up to a byte budget, and optionally also on disk in a directory so they
+    survive between runs. Pass one as the cache= argument of get_file_info() in
+    aggregate_methods.py or collection_methods.py (or of
+    get_matching_file_instances()) to use it.
+
+    A cached document younger than ttl seconds is returned without asking the
+    server. An older one is revalidated: if the server gave an ETag for it, the
+    request carries If-None-Match and a 304 answer keeps the cached copy without
+    downloading the document again. Servers that send no ETag simply get a full
+    request once the ttl has passed.
+
+    Example:
+
+        cache = FileDocCache(ttl=600, max_bytes=256 * 1024 * 1024, directory='/tmp/yadle_files')
+        file_doc = get_file_info(file_id, server, bearer, app_id, cache=cache)
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import yadle_client
+import yadle_json
+
+
+class FileDocCache(object):
+
+    def __init__(self, ttl=300, max_bytes=64 * 1024 * 1024, directory=None):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.size = 0
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        name = hashlib.sha1("{0}|{1}".format(*key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + '.json')
+
+    def _remember(self, key, entry):
+        # Caller holds the lock.
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old['text'])
+
+        if len(entry['text']) > self.max_bytes:
+            return
+
+        self._entries[key] = entry
+        self.size += len(entry['text'])
+
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted['text'])
+
+    def lookup(self, server, file_id):
+        key = (server, file_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+
+        if not self.directory:
+            return None
+
+        try:
+            with open(self._path(key)) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        with self._lock:
+            self._remember(key, entry)
+        return entry
+
+    def store(self, server, file_id, text, etag=None):
+        key = (server, file_id)
+        entry = {'text': text, 'etag': etag, 'fetched': time.time()}
+
+        with self._lock:
+            self._remember(key, entry)
+
+        if self.directory:
+            path = self._path(key)
+            tmp_path = "{0}.{1}.{2}.tmp".format(path, os.getpid(), threading.get_ident())
+            with open(tmp_path, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+
+        return entry
+
+    def invalidate(self, server, file_id):
+        key = (server, file_id)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= len(entry['text'])
+
+        if self.directory:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def get_file_info(self, file_id, server, bearer, app_id, client=None):
+        entry = self.lookup(server, file_id)
+
+        if entry is not None and time.time() - entry['fetched'] < self.ttl:
+            self.hits += 1
+            return yadle_json.loads(entry['text'])
+
+        url = "{0}/yadle/v2/file/{1}".format(server, file_id)
+        headers = {
+            'x-app-id': app_id,
+            'Authorization': bearer,
+            'cache-control': "no-cache"
+            }
+        if entry is not None and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+
+        response = yadle_client.request("GET", url, headers=headers, client=client)
+
+        if response.status_code == 304 and entry is not None:
+            self.revalidated += 1
+            entry = self.store(server, file_id, entry['text'], entry['etag'])
+            return yadle_json.loads(entry['text'])
+
+        if not response:
+            print('ERROR: ' + url + ' returns a null response ' + str(response))
+            print(str(yadle_json.decode(response)))
+            return None
+
+        self.misses += 1
+        self.store(server, file_id, response.text, response.headers.get('ETag'))
+        return yadle_json.decode(response)
@@ -0,0 +1,218 @@
+""" JSON helpers shared by the Yadle API examples.
+
+    decode() turns a response into python objects exactly once, using orjson
+    when it is installed (it is several times faster than the json module) and
+    the standard library otherwise. Set YADLE_JSON_BACKEND=json to force the
+    standard library.
+
+    echo() is how the examples print what they got back. Nothing is formatted
+    unless the current verbosity is at least the level asked for, so batch jobs
+    that set YADLE_VERBOSITY=0 (or call set_verbosity(0)) pay nothing for it.
+    The default verbosity of 1 prints the same output the examples always have;
+    2 and above is for extra detail.
+
+    iter_rows() decodes the "rows" array of a response one row at a time as
+    the body arrives from the socket, instead of buffering the whole body as a
+    string and building the entire object tree with json.loads(). Only the row
+    being decoded (plus one network chunk) is held in memory, so very large
+    search results, user lists and view dumps can be processed on small workers.
+
+    Example:
+
+        response = yadle_client.request("GET", url, headers=headers, stream=True)
+        for row in yadle_json.iter_rows(response):
+            print(row['id'])
+"""
+
+import codecs
+import importlib.util
+import json
+import os
+
+# orjson is imported by loads() the first time it is needed.
+orjson = None
+_has_orjson = importlib.util.find_spec('orjson') is not None
+
+
+CHUNK_SIZE = 64 * 1024
+
+verbosity = int(os.environ.get('YADLE_VERBOSITY', '1'))
+
+backend = os.environ.get('YADLE_JSON_BACKEND', 'orjson' if _has_orjson else 'json')
+
+_WHITESPACE = ' \t\n\r'
+_SEPARATORS = _WHITESPACE + ',]'
+
+_decoder = json.JSONDecoder()
+
+
+class StreamError(ValueError):
+    pass
+
+
+def set_verbosity(level):
+    global verbosity
+    verbosity = int(level)
+
+
+def set_backend(name):
+    global backend
+    if name == 'orjson' and not _has_orjson:
+        raise ValueError("the orjson backend is not installed")
+    if name not in ('orjson', 'json'):
+        raise ValueError("unknown JSON backend: {0}".format(name))
+    backend = name
+
+
+def loads(data):
+    """ Decode a JSON document given as str or bytes. """
+    global orjson
+    if backend == 'orjson':
+        if orjson is None:
+            import orjson
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def echo(obj, level=1, prefix='', pretty=False):
+    # Print obj only if the verbosity is high enough; formatting is skipped otherwise.
+    if verbosity < level:
+        return
+    if pretty:
+        import pprint
+        if prefix:
+            print(prefix)
+        pprint.pprint(obj)
+    else:
+        print(prefix + str(obj))
+
+
+def decode(response, echo_level=None, pretty=False, prefix=''):
+    """ Decode a response body once, echoing the result at echo_level if given. """
+    res = loads(response.content)
+    if echo_level is not None:
+        echo(res, echo_level, prefix=prefix, pretty=pretty)
+    return res
+
+
+def _text_chunks(response, chunk_size):
+    decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        if chunk:
+            yield decoder.decode(chunk)
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+def _find_array(chunks, key):
+    """ Read chunks until the opening bracket of the top level `key` array.
+
+        Returns the unread remainder of the buffer, or None if the document
+        ended without such a key.
+    """
+    target = '"{0}"'.format(key)
+    buf = ''
+    pos = 0
+    depth = 0
+    in_string = False
+    escaped = False
+    string_start = 0
+    expect = None   # after the key: ':' then '['
+
+    for text in chunks:
+        buf += text
+        while pos < len(buf):
+            ch = buf[pos]
+
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == '\\':
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+                    if depth == 1 and buf[string_start:pos + 1] == target:
+                        expect = ':'
+                pos += 1
+                continue
+
+            if ch in _WHITESPACE:
+                pos += 1
+                continue
+
+            if expect == ':':
+                expect = '[' if ch == ':' else None
+                if expect:
+                    pos += 1
+                    continue
+            elif expect == '[':
+                if ch == '[':
+                    return buf[pos + 1:]
+                expect = None
+
+            if ch == '"':
+                in_string = True
+                string_start = pos
+            elif ch in '{[':
+                depth += 1
+            elif ch in '}]':
+                depth -= 1
+            pos += 1
+
+        # Drop what has been scanned, but keep an unfinished string so the key can still be matched.
+        if in_string:
+            buf, string_start, pos = buf[string_start:], 0, pos - string_start
+        else:
+            buf, pos = '', 0
+
+    return None
+
+
+def iter_rows(response, key='rows', chunk_size=CHUNK_SIZE):
+    """ Yield the elements of the top level `key` array of a streamed response.
+
+        The response should have been requested with stream=True. It is closed
+        when the generator finishes or is closed.
+    """
+    try:
+        chunks = _text_chunks(response, chunk_size)
+        buf = _find_array(chunks, key)
+        if buf is None:
+            return
+
+        pos = 0
+        done = False
+        while True:
+            # Skip separators between rows.
+            while pos < len(buf) and (buf[pos] in _WHITESPACE or buf[pos] == ','):
+                pos += 1
+
+            if pos < len(buf) and buf[pos] == ']':
+                return
+
+            row = None
+            if pos < len(buf):
+                try:
+                    row, end = _decoder.raw_decode(buf, pos)
+                except ValueError:
+                    end = None
+
+                # A value that is not followed by a separator may have been cut
+                # short (a number, say), so only accept it once one follows.
+                if end is not None and ((end < len(buf) and buf[end] in _SEPARATORS) or done):
+                    yield row
+                    pos = end
+                    continue
+
+            if done:
+                raise StreamError("response ended inside the '{0}' array".format(key))
+
+            text = next(chunks, None)
+            if text is None:
+                done = True
+            else:
+                buf = buf[pos:] + text
+                pos = 0
+    finally:
+        response.close()
@@ -0,0 +1,269 @@
+""" Per-request timing and size metrics for the Yadle API examples.
+
+    When metrics are enabled, yadle_client.request() records every API call:
+    the endpoint (the url path with ids replaced by placeholders, such as
+    /file/{file_id}/aggregate/{aggregate_id}), the verb, the final status, the
+    latency including retries and backoff, the bytes sent and received, and how
+    many times it was retried. A Metrics object sums these per endpoint, verb
+    and status into latency histograms and exports them as JSON or in the
+    Prometheus text format. Callbacks added with add_callback() also see every
+    call as it finishes.
+
+    Metrics are off by default and cost nothing then. enable() turns on the
+    process-wide `metrics`; a YadleClient can carry its own as client.metrics.
+    Setting YADLE_METRICS_FILE enables them for the whole run and writes them
+    to that file at exit, in the Prometheus format if it ends in .prom or .txt
+    and as JSON otherwise.
+
+    Example:
+
+        metrics = yadle_metrics.enable()
+        metrics.add_callback(lambda call: print(call['method'], call['endpoint'], call['seconds']))
+        ...
+        metrics.write_prometheus('/var/lib/node_exporter/yadle.prom')
+"""
+
+import atexit
+import json
+import os
+import sys
+import threading
+import traceback
+from urllib.parse import urlparse
+
+
+# Upper bounds of the latency histogram buckets, in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Path segments that are followed by an id, and the placeholder it is replaced with.
+_PARAMETERS = {
+    'file': '{file_id}',
+    'aggregate': '{aggregate_id}',
+    'collection': '{collection}',
+    'new_name': '{new_name}',
+    'view': '{view}',
+}
+
+
+def endpoint(url):
+    """ The path of url below /yadle/v2, with ids replaced by placeholders. """
+    parts = urlparse(url).path.split('/')
+    if parts[1:3] == ['yadle', 'v2']:
+        parts = parts[3:]
+
+    result = []
+    placeholder = None
+    for part in parts:
+        if placeholder is not None and not part.startswith('_') and part != 'new':
+            result.append(placeholder)
+        else:
+            result.append(part)
+        placeholder = _PARAMETERS.get(part)
+    return '/'.join(result) if result[:1] == [''] else '/' + '/'.join(result)
+
+
+def _body_size(body):
+    if body is None:
+        return 0
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    return 0
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.retries = 0
+
+    def add(self, seconds, bytes_in, bytes_out, retries):
+        i = 0
+        while i < len(self.buckets) and seconds > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.retries += retries
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th quantile (None above the last bucket).
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+
+class Metrics(object):
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.histograms = {}    # (endpoint, method, status) -> Histogram
+        self.callbacks = []
+        self._lock = threading.Lock()
+
+    def add_callback(self, callback):
+        """
+        Call callback(call) after every request, with the dict that was
+        recorded for it. Exceptions raised by callback are printed to stderr
+        and otherwise ignored.
+        """
+        self.callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        self.callbacks.remove(callback)
+
+    def observe(self, method, url, response, seconds, retries, stream=False):
+        # Record one finished call. response is None when it raised.
+        if response is None:
+            status, bytes_in, bytes_out = 'error', 0, 0
+        else:
+            status = response.status_code
+            bytes_out = _body_size(response.request.body) if response.request is not None else 0
+            length = response.headers.get('Content-Length')
+            if length is not None and length.isdigit():
+                bytes_in = int(length)
+            elif not stream:
+                bytes_in = len(response.content)
+            else:
+                bytes_in = 0
+
+        self.record({
+            'endpoint': endpoint(url),
+            'method': method.upper(),
+            'status': status,
+            'seconds': seconds,
+            'bytes_in': bytes_in,
+            'bytes_out': bytes_out,
+            'retries': retries,
+            'url': url
+        })
+
+    def record(self, call):
+        key = (call['endpoint'], call['method'], str(call['status']))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.add(call['seconds'], call['bytes_in'], call['bytes_out'], call['retries'])
+
+        # A failing callback must not turn a finished API call into an error.
+        for callback in list(self.callbacks):
+            try:
+                callback(call)
+            except Exception:
+                sys.stderr.write('ERROR: metrics callback failed: ' + traceback.format_exc())
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+
+    # export
+
+    def to_json(self):
+        with self._lock:
+            items = sorted(self.histograms.items())
+            return [{
+                'endpoint': endpoint_name,
+                'method': method,
+                'status': status,
+                'count': h.count,
+                'seconds_sum': h.sum,
+                'seconds_mean': h.sum / h.count,
+                'seconds_p50': h.quantile(0.5),
+                'seconds_p99': h.quantile(0.99),
+                'bytes_in': h.bytes_in,
+                'bytes_out': h.bytes_out,
+                'retries': h.retries,
+                'buckets': dict(zip([str(b) for b in h.buckets] + ['+Inf'], h.counts))
+            } for (endpoint_name, method, status), h in items]
+
+    def prometheus_text(self):
+        lines = [
+            '# HELP yadle_request_seconds Latency of Yadle API calls, including retries.',
+            '# TYPE yadle_request_seconds histogram',
+        ]
+        totals = []
+
+        with self._lock:
+            for (endpoint_name, method, status), h in sorted(self.histograms.items()):
+                labels = 'endpoint="{0}",method="{1}",status="{2}"'.format(endpoint_name, method, status)
+                cumulative = 0
+                for bound, count in zip([repr(b) for b in h.buckets] + ['+Inf'], h.counts):
+                    cumulative += count
+                    lines.append('yadle_request_seconds_bucket{{{0},le="{1}"}} {2}'.format(labels, bound, cumulative))
+                lines.append('yadle_request_seconds_sum{{{0}}} {1!r}'.format(labels, h.sum))
+                lines.append('yadle_request_seconds_count{{{0}}} {1}'.format(labels, h.count))
+                totals.append((labels, h))
+
+        for name, attribute, help_text in (('yadle_request_bytes_in_total', 'bytes_in', 'Response bytes received.'),
+                                           ('yadle_request_bytes_out_total', 'bytes_out', 'Request body bytes sent.'),
+                                           ('yadle_request_retries_total', 'retries', 'Retries after throttling or errors.')):
+            lines.append('# HELP {0} {1}'.format(name, help_text))
+            lines.append('# TYPE {0} counter'.format(name))
+            for labels, h in totals:
+                lines.append('{0}{{{1}}} {2}'.format(name, labels, getattr(h, attribute)))
+
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path):
+        _write(path, json.dumps(self.to_json(), indent=2))
+
+    def write_prometheus(self, path):
+        _write(path, self.prometheus_text())
+
+    def write(self, path):
+        if path.endswith('.prom') or path.endswith('.txt'):
+            self.write_prometheus(path)
+        else:
+            self.write_json(path)
+
+
+def _write(path, text):
+    # Replace the file in one step, so a scraper never reads half of it.
+    tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+metrics = None
+
+
+def enable(buckets=DEFAULT_BUCKETS):
+    """ Turn on the process-wide metrics and return them. """
+    global metrics
+    if metrics is None:
+        metrics = Metrics(buckets)
+    return metrics
+
+
+def disable():
+    global metrics
+    metrics = None
+
+
+def recorder(client=None):
+    # The Metrics to record a call of client in, or None when metrics are off.
+    return getattr(client, 'metrics', None) or metrics
+
+
+def _write_at_exit(path):
+    if metrics is not None:
+        metrics.write(path)
+
+
+if os.environ.get('YADLE_METRICS_FILE'):
+    enable()
+    atexit.register(_write_at_exit, os.environ['YADLE_METRICS_FILE'])
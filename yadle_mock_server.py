@@ -0,0 +1,446 @@
+""" Local stand-in for the Yadle API, for benchmarks and offline runs.
+
+    A MockYadleServer answers the endpoints the examples use, from generated
+    data held in memory:
+
+        POST   /yadle/v2/auth/login
+        POST   /yadle/v2/search
+        GET    /yadle/v2/user/_all
+        POST   /yadle/v2/user/invite
+        GET    /yadle/v2/file/{file_id}                 (with ETag / If-None-Match)
+        *      /yadle/v2/file/{file_id}/aggregate/...   (new, _all, {id}, edit_primary, entire)
+        *      /yadle/v2/collection/...                 ({name}, _all, new_name, entire)
+        GET    /yadle/v2/utility/view/{org}_catalog/_design/path_to_id/_view/path_to_id3
+        GET    /_mock/stats                             (request counters)
+
+    It has `files` files spread over `dirs` directories (every other one in a
+    subdirectory, and each on two devices), `users` users and `hits` search
+    hits. Every file document and full search row carries `payload_bytes` of
+    padding. Each request waits `latency` seconds plus up to `jitter` more, and
+    is answered with a 500 with probability `error_rate` or with a 429 with
+    probability `throttle_rate`. Aggregates and collections are kept in memory
+    and change as requests arrive.
+
+    Example:
+
+        with MockYadleServer(files=5000, latency=0.01, error_rate=0.001) as server:
+            bearer = logIn(server.url, 'user', 'password')
+            search(bearer, 'appid', server.url, 0, 20, None, 'red car')
+
+    From the command line:
+
+        python yadle_mock_server.py --port 8000 --latency 0.02 --files 100000
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+
+DEVICES = ['device1', 'device2']
+
+
+class MockData(object):
+
+    def __init__(self, files=1000, dirs=20, users=1000, hits=1000, payload_bytes=256,
+                 latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, seed=None):
+        self.files = files
+        self.dirs = dirs
+        self.users = users
+        self.hits = hits
+        self.padding = 'x' * payload_bytes
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+
+        self.aggregates = {}    # aggregate id -> {'head': file id, 'members': [file ids]}
+        self.collections = {}   # name -> {file_id: {device_id: [path_id]}}
+        self.next_aggregate = 0
+        self.requests = 0
+        self.statuses = {}
+        self.lock = threading.RLock()
+
+        # path_to_id view rows, sorted by (key, id) like the real view.
+        self.view = sorted((device_id + '_' + self.file_dir(i), self.file_id(i), device_id, i)
+                           for i in range(files) for device_id in DEVICES)
+        self.view_keys = [(key, file_id) for key, file_id, _, _ in self.view]
+
+    # generated data
+
+    def file_id(self, i):
+        return 'file{0:07d}'.format(i)
+
+    def file_index(self, file_id):
+        try:
+            i = int(file_id[4:])
+        except ValueError:
+            return None
+        return i if file_id.startswith('file') and 0 <= i < self.files else None
+
+    def file_dir(self, i):
+        directory = '/data/dir{0}/'.format(i % self.dirs)
+        if i % 2:
+            directory += 'sub{0}/'.format(i % 3)
+        return directory
+
+    def file_doc(self, i):
+        path_id = 'path{0}'.format(i)
+        return {
+            '_id': self.file_id(i),
+            'name': 'file{0}.dat'.format(i),
+            'size': 1024 + i,
+            'description': self.padding,
+            'device': dict((device_id, {'files': {path_id: {'dir': self.file_dir(i), 'name': 'file{0}.dat'.format(i)}}})
+                           for device_id in DEVICES)
+        }
+
+    def user(self, i):
+        return {
+            'id': 'user{0}@example.com'.format(i),
+            'email': 'user{0}@example.com'.format(i),
+            'firstName': 'First{0}'.format(i),
+            'lastName': 'Last{0}'.format(i),
+            'status': 'active' if i % 5 else 'invited'
+        }
+
+    def view_rows(self, query):
+        def value(name):
+            # Accept both plain and JSON encoded keys.
+            text = query.get(name)
+            if text is not None and text.startswith('"'):
+                try:
+                    return json.loads(text)
+                except ValueError:
+                    pass
+            return text
+
+        if query.get('key') is not None:
+            start, end = value('key'), value('key')
+        else:
+            start, end = value('startkey') or '', value('endkey')
+
+        first = bisect_left(self.view_keys, (start, value('startkey_docid') or ''))
+        first += int(query.get('skip') or 0)
+        limit = int(query.get('limit') or len(self.view))
+
+        rows = []
+        for key, file_id, device_id, i in self.view[first:]:
+            if len(rows) >= limit or (end is not None and key > end):
+                break
+            rows.append({'id': file_id, 'key': key, 'value': {'device': device_id, 'path_id': 'path{0}'.format(i)}})
+        return rows
+
+
+NOT_FOUND = (404, {'error': 'not_found'})
+
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    # Headers and body go out as separate writes; without this every response
+    # waits for the client's delayed ACK.
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_api('GET')
+
+    def do_POST(self):
+        self.handle_api('POST')
+
+    def do_PATCH(self):
+        self.handle_api('PATCH')
+
+    def do_DELETE(self):
+        self.handle_api('DELETE')
+
+    def do_PUT(self):
+        self.handle_api('PUT')
+
+    def send(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.headers.get('Content-Type', '').startswith('application/json') and body:
+            return json.loads(body.decode('utf-8'))
+        return parse_qs(body.decode('utf-8'))
+
+    def handle_api(self, method):
+        data = self.server.data
+        url = urlparse(self.path)
+        query = dict((name, values[-1]) for name, values in parse_qs(url.query, keep_blank_values=True).items())
+        body = self.read_body()
+
+        if url.path == '/_mock/stats':
+            with data.lock:
+                stats = {'requests': data.requests, 'statuses': dict(data.statuses)}
+            return self.send(200, stats)
+
+        with data.lock:
+            data.requests += 1
+            roll = data.random.random()
+
+        delay = data.latency + (random.uniform(0, data.jitter) if data.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+        if roll < data.error_rate:
+            answer = (500, {'error': 'injected_error'})
+        elif roll < data.error_rate + data.throttle_rate:
+            answer = (429, {'error': 'too_many_requests'}, {'Retry-After': '0'})
+        elif not url.path.startswith('/yadle/v2/'):
+            answer = NOT_FOUND
+        else:
+            parts = [unquote(part) for part in url.path[len('/yadle/v2/'):].split('/')]
+            handler = getattr(self, 'api_' + parts[0], None)
+            try:
+                answer = handler(method, parts[1:], query, body) if handler is not None else NOT_FOUND
+            except (KeyError, IndexError, ValueError, TypeError, AttributeError) as e:
+                answer = (400, {'error': 'bad_request', 'reason': str(e)})
+
+        with data.lock:
+            data.statuses[answer[0]] = data.statuses.get(answer[0], 0) + 1
+
+        self.send(*answer)
+
+    # endpoints; each returns (status, body) or (status, body, headers)
+
+    def api_auth(self, method, parts, query, body):
+        if parts != ['login'] or method != 'POST':
+            return NOT_FOUND
+        if not body.get('username') or not body.get('password'):
+            return (401, {'error': 'unauthorized'})
+        return (200, {'token': 'mock-token', 'password': 'mock-password'})
+
+    def api_search(self, method, parts, query, body):
+        data = self.server.data
+        skip = int(query.get('skip') or 0)
+        limit = int(query.get('limit') or 20)
+        quiet = query.get('quiet') == 'true'
+
+        rows = []
+        for n in range(skip, min(skip + limit, data.hits)):
+            i = n % data.files
+            if quiet:
+                rows.append({'id': data.file_id(i)})
+            else:
+                rows.append({'id': data.file_id(i), 'name': 'file{0}.dat'.format(i), 'score': 1.0 / (n + 1),
+                             'description': data.padding})
+        return (200, {'total_rows': data.hits, 'offset': skip, 'rows': rows})
+
+    def api_user(self, method, parts, query, body):
+        data = self.server.data
+        if parts == ['_all'] and method == 'GET':
+            skip = int(query.get('skip') or 0)
+            limit = int(query.get('limit') or data.users)
+            rows = [data.user(i) for i in range(skip, min(skip + limit, data.users))]
+            return (200, {'total_rows': data.users, 'rows': rows})
+        if parts == ['invite'] and method == 'POST':
+            return (200, {'code': 200, 'email': body.get('email', [''])[-1]})
+        return NOT_FOUND
+
+    def api_file(self, method, parts, query, body):
+        data = self.server.data
+        i = data.file_index(parts[0])
+        if i is None:
+            return NOT_FOUND
+
+        if len(parts) == 1:
+            etag = '"{0}-1"'.format(parts[0])
+            if self.headers.get('If-None-Match') == etag:
+                return (304, None, {'ETag': etag})
+            return (200, data.file_doc(i), {'ETag': etag})
+
+        if parts[1] == 'aggregate':
+            with data.lock:
+                return self.aggregate(method, parts[0], parts[2:], body)
+        return NOT_FOUND
+
+    def aggregate(self, method, file_id, parts, body):
+        # Caller holds the lock.
+        data = self.server.data
+        if parts == ['new'] and method == 'POST':
+            data.next_aggregate += 1
+            aggregate_id = 'aggregate{0}'.format(data.next_aggregate)
+            data.aggregates[aggregate_id] = {'head': file_id, 'members': [f for f in body if f != file_id]}
+            return (200, {'code': 200, 'aggregate_id': aggregate_id})
+
+        if parts == ['_all'] and method == 'GET':
+            found = [dict(aggregate_id=aggregate_id, primary=doc['head'], members=list(doc['members']))
+                     for aggregate_id, doc in data.aggregates.items()
+                     if doc['head'] == file_id or file_id in doc['members']]
+            return (200, {'aggregates': found})
+
+        doc = data.aggregates.get(parts[0])
+        if doc is None:
+            return NOT_FOUND
+
+        if len(parts) == 1 and method == 'GET':
+            return (200, dict(doc, members=list(doc['members']), aggregate_id=parts[0]))
+        if len(parts) == 1 and method == 'PATCH':
+            doc['members'] += [f for f in body if f not in doc['members']]
+        elif len(parts) == 1 and method == 'DELETE':
+            doc['members'] = [f for f in doc['members'] if f not in body]
+        elif parts[1:] == ['edit_primary'] and method == 'PATCH':
+            if body[0] not in doc['members']:
+                return (400, {'error': 'not_a_member', 'code': 400})
+            doc['members'] = [f for f in doc['members'] if f != body[0]] + [doc['head']]
+            doc['head'] = body[0]
+        elif parts[1:] == ['entire'] and method == 'DELETE':
+            del data.aggregates[parts[0]]
+        else:
+            return NOT_FOUND
+        return (200, {'code': 200})
+
+    def api_collection(self, method, parts, query, body):
+        data = self.server.data
+        with data.lock:
+            return self.collection(method, parts[0], parts[1:], body)
+
+    def collection(self, method, name, parts, body):
+        # Caller holds the lock.
+        data = self.server.data
+        if name == '_all' and method == 'GET':
+            return (200, {'rows': sorted(data.collections)})
+
+        members = data.collections.get(name)
+        if not parts and method == 'POST':
+            if members is not None:
+                return (409, {'error': 'conflict'})
+            data.collections[name] = {}
+            merge_members(data.collections[name], body)
+            return (200, {'code': 200})
+
+        if members is None:
+            return NOT_FOUND
+
+        if not parts and method == 'GET':
+            return (200, {'name': name, 'files': json.loads(json.dumps(members))})
+        if not parts and method == 'PATCH':
+            merge_members(members, body)
+        elif not parts and method == 'DELETE':
+            remove_members(members, body)
+        elif len(parts) == 2 and parts[0] == 'new_name' and method == 'PATCH':
+            data.collections[parts[1]] = data.collections.pop(name)
+        elif parts == ['entire'] and method == 'DELETE':
+            del data.collections[name]
+        else:
+            return NOT_FOUND
+        return (200, {'code': 200})
+
+    def api_utility(self, method, parts, query, body):
+        if method != 'GET' or parts[0] != 'view' or parts[-1] != 'path_to_id3':
+            return NOT_FOUND
+        data = self.server.data
+        return (200, {'total_rows': len(data.view), 'rows': data.view_rows(query)})
+
+
+def merge_members(members, body):
+    for file_id, devices in body.items():
+        for device_id, path_ids in devices.items():
+            current = members.setdefault(file_id, {}).setdefault(device_id, [])
+            current += [p for p in path_ids if p not in current]
+
+
+def remove_members(members, body):
+    for file_id, devices in body.items():
+        for device_id, path_ids in devices.items():
+            kept = [p for p in members.get(file_id, {}).get(device_id, []) if p not in path_ids]
+            if kept:
+                members[file_id][device_id] = kept
+            elif device_id in members.get(file_id, {}):
+                del members[file_id][device_id]
+        if file_id in members and not members[file_id]:
+            del members[file_id]
+
+
+
+class MockYadleServer(object):
+
+    def __init__(self, port=0, host='127.0.0.1', **options):
+        self.httpd = ThreadingHTTPServer((host, port), MockHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.data = MockData(**options)
+        self.data = self.httpd.data
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return "http://{0}:{1}".format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def add_arguments(parser):
+    # Options shared with benchmark.py.
+    parser.add_argument("--files", required=False, type=int, default=1000)
+    parser.add_argument("--dirs", required=False, type=int, default=20)
+    parser.add_argument("--users", required=False, type=int, default=1000)
+    parser.add_argument("--hits", required=False, type=int, default=1000)
+    parser.add_argument("--payload", required=False, type=int, default=256, help="bytes of padding per document")
+    parser.add_argument("--latency", required=False, type=float, default=0.0, help="seconds per request")
+    parser.add_argument("--jitter", required=False, type=float, default=0.0, help="up to this many seconds more")
+    parser.add_argument("--errorrate", required=False, type=float, default=0.0, help="fraction answered with 500")
+    parser.add_argument("--throttlerate", required=False, type=float, default=0.0, help="fraction answered with 429")
+    parser.add_argument("--seed", required=False, type=int)
+
+
+def options(args):
+    return dict(files=args.files, dirs=args.dirs, users=args.users, hits=args.hits, payload_bytes=args.payload,
+                latency=args.latency, jitter=args.jitter, error_rate=args.errorrate,
+                throttle_rate=args.throttlerate, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", required=False, default='127.0.0.1')
+    parser.add_argument("--port", required=False, type=int, default=8000)
+    add_arguments(parser)
+
+    args = parser.parse_args()
+
+    server = MockYadleServer(args.port, args.host, **options(args))
+    print("mock Yadle API on " + server.url)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+""" Retry, backoff and adaptive concurrency for requests to the Yadle API.
+
+    yadle_client.request() sends every call through send() below, so all of the
+    examples share one policy:
+
+    - A request answered with 429, 502, 503 or 504, or that fails to connect,
+      is retried up to max_retries times. Only idempotent verbs (GET, PUT,
+      DELETE, HEAD, OPTIONS) are retried on errors that may have reached the
+      server; POST and PATCH are only retried on 429, which means the server
+      did not handle the request.
+    - The wait before a retry is the server's Retry-After when it sends one,
+      and otherwise a random ("full jitter") fraction of an exponentially
+      growing backoff, so many workers do not retry in lockstep.
+    - An AdaptiveLimiter caps how many requests are in flight at once across
+      all threads. It halves the cap whenever the server throttles (429 or 503)
+      and grows it back by about one per cap's worth of successful requests.
+      Thread pools larger than the cap simply wait their turn.
+
+    The defaults are the module level `policy` and `limiter`; a YadleClient can
+    carry its own as client.retry_policy and client.limiter.
+"""
+
+import random
+import threading
+import time
+
+
+IDEMPOTENT_METHODS = frozenset(['GET', 'PUT', 'DELETE', 'HEAD', 'OPTIONS'])
+
+RETRY_STATUSES = frozenset([429, 502, 503, 504])
+
+THROTTLE_STATUSES = frozenset([429, 503])
+
+
+class RetryPolicy(object):
+
+    def __init__(self, max_retries=5, backoff=0.5, max_backoff=30.0,
+                 statuses=RETRY_STATUSES, methods=IDEMPOTENT_METHODS):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = statuses
+        self.methods = methods
+
+    def should_retry(self, method, status, attempt):
+        if attempt >= self.max_retries or status not in self.statuses:
+            return False
+        return method.upper() in self.methods or status == 429
+
+    def should_retry_error(self, method, attempt):
+        return attempt < self.max_retries and method.upper() in self.methods
+
+    def delay(self, attempt, response=None):
+        if response is not None:
+            wait = retry_after(response)
+            if wait is not None:
+                return min(wait, self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+
+def retry_after(response):
+    # Seconds to wait according to a Retry-After header, or None.
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    import email.utils
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+class AdaptiveLimiter(object):
+    """ Additive increase, multiplicative decrease cap on concurrent requests. """
+
+    def __init__(self, initial=8, minimum=1, maximum=64):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.throttled = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                self.limit = max(self.minimum, self.limit / 2)
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+
+policy = RetryPolicy()
+
+limiter = AdaptiveLimiter()
+
+
+def send(do_request, method, client=None):
+    """ Call do_request() under the limiter, retrying it as the policy allows. """
+    import requests
+
+    retry_policy = getattr(client, 'retry_policy', None) or policy
+    request_limiter = getattr(client, 'limiter', None) or limiter
+
+    attempt = 0
+    while True:
+        request_limiter.acquire()
+        try:
+            response = do_request()
+        except (requests.ConnectionError, requests.Timeout):
+            request_limiter.release()
+            if not retry_policy.should_retry_error(method, attempt):
+                raise
+            wait = retry_policy.delay(attempt)
+        else:
+            request_limiter.release(response.status_code in THROTTLE_STATUSES)
+            if not retry_policy.should_retry(method, response.status_code, attempt):
+                return response
+            wait = retry_policy.delay(attempt, response)
+            response.close()
+
+        time.sleep(wait)
+        attempt += 1
@@ -62,7 +62,41 @@
 #           { "terms": ' "red car" honda #"3d model" ' }
 #            searches red car, honda, and #3d model
 #
-# 
+# stream_search() takes the same arguments as search() but returns a generator
+# that decodes the rows one at a time as the response arrives, so a large page
+# never has to fit in memory at once.
+#
+# To get every result rather than a single page, use iter_search(). It yields
+# the rows of each page in turn and keeps the next page(s) in flight while
+# the current one is being consumed:
+#
+# def iter_search(bearer, appid, apiserver, terms, quiet=None, skip=0, page_size=100, prefetch=1):
+#
+# page_size - (optional) The limit used for each page request.
+#
+# prefetch - (optional) How many pages to request ahead of the one being consumed.
+#
+# For large result sets, parallel_search() learns the total hit count from the
+# first window and then fetches the remaining skip/limit windows concurrently:
+#
+# def parallel_search(bearer, appid, apiserver, terms, quiet=None, window=500, workers=4, ordered=True):
+#
+# window - (optional) The limit used for each window request.
+#
+# workers - (optional) How many windows may be requested at the same time.
+#
+# ordered - (optional) If False, rows are yielded window by window in whatever
+#           order the windows arrive instead of in result order.
+#
+# search_and_hydrate(bearer, appid, apiserver, skip, limit, terms, file_cache)
+# runs a quiet search first and then fetches the full documents of only those
+# ids that are not already in file_cache, a yadle_file_cache.FileDocCache.
+#
+# search() and search_page() also take an optional cache, a
+# yadle_search_cache.SearchCache. Results are then reused for equivalent
+# queries (see normalize_terms()) until they expire; bypass_cache=True always
+# asks the server and refreshes the cached copy.
+#
 #
 # Command line usage:
 # While the code below can be used as a module, it can also be launched from the command line.
@@ -77,6 +111,13 @@
 #   --limit
 #   --quiet
 #   --terms
+#   --cachedir    directory to cache results in (see yadle_search_cache.py)
+#   --cachettl    seconds a cached result stays valid (default 60)
+#   --nocache     ask the server even if a cached result exists
+#   --batch       file of queries to run instead of --terms, one per line ('-' for stdin);
+#                 see read_queries() for the line format
+#   --output      file to write the batch results to as json lines (default stdout)
+#   --workers     how many batch queries to run at the same time (default 8)
 #
 #   Example usage:
 #   python yadle_search.py \
@@ -90,29 +131,62 @@
 #       --terms='"star trek" #"3d model"'
 
 
-import requests
+import yadle_auth
+import yadle_client
+import yadle_json
+import sys
+import re
 import json
-import pprint
-import traceback, sys
-import argparse
+from collections import deque
+from itertools import islice
 
 
 
-def logIn(apiserver, username, password):
-    url = "{0}/yadle/v2/auth/login".format(apiserver)
-    payload = "username={0}&password={1}&undefined=".format(username, password)
-    headers = {
-        'Content-Type': "application/x-www-form-urlencoded",
-        }
+def logIn(apiserver, username, password, client=None):
+    # Reuses a bearer cached by an earlier run when there is one (see yadle_auth.py).
+    return yadle_auth.logIn(apiserver, username, password, client=client)
+
+_TERM = re.compile(r'#?"[^"]*"|\S+')
+
+def normalize_term(term):
+    # '"red  car"' -> '"red car"', '"honda"' -> 'honda', '#"3d  model"' -> '#"3d model"', '#"tag"' -> '#tag'
+    tag = term.startswith('#')
+    if tag:
+        term = term[1:]
+
+    if len(term) >= 2 and term.startswith('"') and term.endswith('"'):
+        term = ' '.join(term[1:-1].split())
+        if not term:
+            return None
+        if ' ' in term:
+            term = '"{0}"'.format(term)
+
+    return '#' + term if tag else term
 
-    response = requests.request("POST", url, data=payload, headers=headers)
- 
-    # get Bearer
-    res = json.loads(response.text)
-    bearer = "Bearer {0}:{1}".format(res['token'], res['password'])
-    return bearer
+def normalize_terms(terms):
+    """
+    Canonical form of a search, so equivalent queries compare equal.
 
-def search(bearer, appid, apiserver, skip, limit, quiet, terms):
+    terms is the {"terms": ...} object passed to search() or the terms string
+    itself. Whitespace inside and between terms is collapsed and quotes around
+    single words (including tags) are dropped. The order of the terms and any
+    repeated terms are kept, since the server may rank on them.
+    """
+    if isinstance(terms, dict):
+        terms = terms.get('terms')
+    if not terms:
+        return ''
+
+    normalized = []
+    for term in _TERM.findall(terms):
+        term = normalize_term(term)
+        if term:
+            normalized.append(term)
+
+    return ' '.join(normalized)
+
+def search_request(bearer, appid, apiserver, skip, limit, quiet, terms, client=None, stream=False):
+    # Send the search and return the url and the undecoded response.
     skipString = ""
     limitString = ""
     quietString = ""
@@ -128,19 +202,52 @@ def search(bearer, appid, apiserver, skip, limit, quiet, terms):
 
     url = "{0}/yadle/v2/search?{1}&{2}&{3}".format(apiserver, skipString, limitString, quietString)
 
-    print(url)
-        
     headers = {
         'x-app-id': appid,
         'Authorization': bearer,
         'cache-control': "no-cache"
     }
 
-    response = requests.request("POST", url, data=terms, headers=headers)
+    response = yadle_client.request("POST", url, data=terms, headers=headers, client=client, stream=stream)
+
+    return url, response
+
+def search_page(bearer, appid, apiserver, skip, limit, quiet, terms, client=None, cache=None, bypass_cache=False,
+                check=False):
+    # Fetch one page of results without printing anything. With check=True an
+    # error response raises requests.HTTPError instead of being returned.
+    if cache is not None and not bypass_cache:
+        cached = cache.get(apiserver, appid, terms, skip, limit, quiet)
+        if cached is not None:
+            return cached
+
+    url, response = search_request(bearer, appid, apiserver, skip, limit, quiet, terms, client=client)
+    if check:
+        response.raise_for_status()
+    res = yadle_json.decode(response)
+
+    if cache is not None and response.ok:
+        cache.put(apiserver, appid, terms, skip, limit, quiet, url, res)
+
+    return url, res
+
+def stream_search(bearer, appid, apiserver, skip, limit, quiet, terms, client=None):
+    """
+    Same request as search(), but yields the rows one at a time as they are
+    decoded from the socket instead of loading the whole response into memory.
+    """
+    url, response = search_request(bearer, appid, apiserver, skip, limit, quiet, terms, client=client, stream=True)
+    response.raise_for_status()
 
-    res = json.loads(response.text)
+    return yadle_json.iter_rows(response)
 
-    pprint.pprint(res)
+def search(bearer, appid, apiserver, skip, limit, quiet, terms, client=None, cache=None, bypass_cache=False):
+    url, res = search_page(bearer, appid, apiserver, skip, limit, quiet, terms, client=client,
+                           cache=cache, bypass_cache=bypass_cache)
+
+    yadle_json.echo(url)
+
+    yadle_json.echo(res, pretty=True)
 
     # loop through individual files
     # for file in res['rows']:
@@ -150,9 +257,220 @@ def search(bearer, appid, apiserver, skip, limit, quiet, terms):
 
     return res
 
+def iter_search(bearer, appid, apiserver, terms, quiet=None, skip=0, page_size=100, prefetch=1, client=None):
+    """
+    Yield every row of a search, across as many pages as it takes.
+
+    While the rows of one page are being consumed, the next `prefetch` pages
+    are already being fetched in the background. Iteration stops after the
+    first page that comes back with fewer than page_size rows. A page that
+    fails raises requests.HTTPError, so it is never taken for the last page.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    skip = int(skip or 0)
+    page_size = int(page_size)
+    executor = ThreadPoolExecutor(max_workers=max(1, prefetch))
+    pending = deque()
+
+    def fetch(page_skip):
+        return search_page(bearer, appid, apiserver, page_skip, page_size, quiet, terms, client=client, check=True)[1]
+
+    try:
+        next_skip = skip
+        for _ in range(prefetch + 1):
+            pending.append(executor.submit(fetch, next_skip))
+            next_skip += page_size
+
+        while pending:
+            rows = pending.popleft().result().get('rows', [])
+
+            for row in rows:
+                yield row
+
+            if len(rows) < page_size:
+                break
+
+            pending.append(executor.submit(fetch, next_skip))
+            next_skip += page_size
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+def total_hits(res):
+    # Total number of hits reported with a page of results, or None if the server did not say.
+    for key in ('total_rows', 'total'):
+        if key in res:
+            return int(res[key])
+    return None
+
+def parallel_search(bearer, appid, apiserver, terms, quiet=None, window=500, workers=4, ordered=True, client=None):
+    """
+    Yield every row of a search by fetching disjoint skip/limit windows concurrently.
+
+    The first window is fetched on its own to learn the total hit count; the
+    remaining windows are then requested by up to `workers` threads. With
+    ordered=True rows come out in result order, otherwise each window's rows are
+    yielded as soon as that window arrives. Falls back to iter_search() when the
+    server does not report a total. A window that fails raises requests.HTTPError
+    rather than being left out.
+    """
+    window = int(window)
+    first = search_page(bearer, appid, apiserver, 0, window, quiet, terms, client=client, check=True)[1]
+    rows = first.get('rows', [])
+
+    for row in rows:
+        yield row
+
+    total = total_hits(first)
+    if len(rows) < window:
+        return
+
+    if total is None:
+        for row in iter_search(bearer, appid, apiserver, terms, quiet=quiet, skip=window,
+                               page_size=window, prefetch=workers, client=client):
+            yield row
+        return
+
+    def fetch(window_skip):
+        return search_page(bearer, appid, apiserver, window_skip, window, quiet, terms, client=client,
+                           check=True)[1].get('rows', [])
+
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    skips = iter(range(window, total, window))
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = deque()
+
+    try:
+        # Keep at most two windows per worker outstanding so memory stays bounded.
+        for window_skip in islice(skips, workers * 2):
+            pending.append(executor.submit(fetch, window_skip))
+
+        while pending:
+            if ordered:
+                future = pending.popleft()
+            else:
+                future = next(as_completed(pending))
+                pending.remove(future)
+
+            for row in future.result():
+                yield row
+
+            for window_skip in islice(skips, 1):
+                pending.append(executor.submit(fetch, window_skip))
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def row_id(row):
+    # File id of a search row; quiet searches may return bare ids.
+    if isinstance(row, dict):
+        return row.get('id') or row.get('_id')
+    return row
+
+def search_and_hydrate(bearer, appid, apiserver, skip, limit, terms, file_cache=None, workers=8, client=None):
+    """
+    Two-phase search: run the search with quiet=true to get only the file ids,
+    then fetch the full documents of just the ids that file_cache (a
+    yadle_file_cache.FileDocCache) does not already hold, up to `workers` at a time.
+
+    Returns the quiet search response with its rows replaced by the file
+    documents, in the same order. Ids whose document could not be fetched are
+    left out.
+    """
+    import yadle_file_cache
+
+    if file_cache is None:
+        file_cache = yadle_file_cache.FileDocCache()
+
+    res = search_page(bearer, appid, apiserver, skip, limit, True, terms, client=client)[1]
+
+    def hydrate(file_id):
+        return file_cache.get_file_info(file_id, apiserver, bearer, appid, client=client)
+
+    ids = [row_id(row) for row in res.get('rows', [])]
+    res['rows'] = [doc for doc in yadle_client.bounded_map(hydrate, ids, workers) if doc is not None]
+
+    return res
+
+def read_queries(lines, skip=None, limit=None, quiet=None):
+    """
+    Queries for batch_search(), one per non-empty line. A line is either a terms
+    string or a json object like {"terms": "...", "skip": 0, "limit": 20, "quiet": true};
+    skip, limit and quiet default to the arguments given here.
+    """
+    queries = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        query = {'skip': skip, 'limit': limit, 'quiet': quiet}
+        if line.startswith('{'):
+            query.update(json.loads(line))
+        else:
+            query['terms'] = line
+        queries.append(query)
+
+    return queries
+
+def query_key(query):
+    # Queries with the same key return the same results.
+    quiet = query.get('quiet') == True or query.get('quiet') == 'true'
+    skip = int(query['skip']) if query.get('skip') is not None else None
+    limit = int(query['limit']) if query.get('limit') is not None else None
+    return (normalize_terms(query.get('terms')), skip, limit, quiet)
+
+def batch_search(bearer, appid, apiserver, queries, out, workers=8, client=None, cache=None):
+    """
+    Run many searches concurrently over one login, running equivalent queries
+    (same query_key()) only once.
+
+    One json line is written to the file object `out` per distinct query, as
+    soon as it and all queries before it have finished:
+        {"lines": [indexes of the queries it answers], "terms": [their terms],
+         "skip": ..., "limit": ..., "quiet": ..., "result": {...search response...}}
+    Returns the number of distinct queries run.
+    """
+    distinct = {}
+    for i, query in enumerate(queries):
+        key = query_key(query)
+        if key not in distinct:
+            distinct[key] = []
+        distinct[key].append((i, query))
+
+    def run(item):
+        key, group = item
+        query = group[0][1]
+        try:
+            res = search_page(bearer, appid, apiserver, key[1], key[2], key[3], { 'terms': query.get('terms') },
+                              client=client, cache=cache)[1]
+        except Exception as e:
+            res = { 'error': str(e) }
+        return key, group, res
+
+    for key, group, res in yadle_client.bounded_map(run, distinct.items(), workers):
+        record = {
+            'lines': [i for i, _ in group],
+            'terms': [query.get('terms') for _, query in group],
+            'skip': key[1],
+            'limit': key[2],
+            'quiet': key[3],
+            'result': res
+        }
+        out.write(json.dumps(record) + '\n')
+        out.flush()
+
+    return len(distinct)
 
 
 def main():
+    import argparse
+
     parser = argparse.ArgumentParser()
     parser.add_argument("--apiserver", required=True)
     parser.add_argument("--user", required=True)
@@ -162,17 +480,44 @@ def main():
     parser.add_argument("--skip", required=False)
     parser.add_argument("--limit", required=False)
     parser.add_argument("--terms", required=False)
+    parser.add_argument("--cachedir", required=False)
+    parser.add_argument("--cachettl", required=False, type=float, default=60)
+    parser.add_argument("--nocache", required=False, action='store_true')
+    parser.add_argument("--batch", required=False)
+    parser.add_argument("--output", required=False)
+    parser.add_argument("--workers", required=False, type=int, default=8)
     args = parser.parse_args()
 
     terms = {
         "terms": args.terms    
     }
 
-    print(terms)
+    if not args.batch:
+        print(terms)
 
     # log in and get the bearer that will be used to authenticate search requests
     bearer = logIn(args.apiserver, args.user, args.password)
 
+    cache = None
+    if args.cachedir:
+        import yadle_search_cache
+        cache = yadle_search_cache.SearchCache(args.cachedir, ttl=args.cachettl)
+
+    if args.batch:
+        if args.batch == '-':
+            queries = read_queries(sys.stdin, args.skip, args.limit, args.quiet)
+        else:
+            with open(args.batch) as f:
+                queries = read_queries(f, args.skip, args.limit, args.quiet)
+
+        out = open(args.output, 'w') if args.output else sys.stdout
+        try:
+            batch_search(bearer, args.appid, args.apiserver, queries, out,
+                         workers=args.workers, cache=cache)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        return
 
     search(
         bearer=bearer, 
@@ -181,7 +526,9 @@ def main():
         skip=args.skip, 
         limit=args.limit, 
         quiet=args.quiet,
-        terms=terms)
+        terms=terms,
+        cache=cache,
+        bypass_cache=args.nocache)
 
 
 if __name__ == "__main__":
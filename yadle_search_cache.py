@@ -0,0 +1,150 @@
+""" Disk cache of search results for yadle_search.search().
+
+    A SearchCache stores each search response as a small json file in a
+    directory, keyed on the apiserver, app id, normalized terms (see
+    yadle_search.normalize_terms()), skip, limit and quiet. So
+    ' "red  car"  "honda" ' and '"red car" honda' share an entry.
+
+    Entries older than ttl seconds are ignored and removed. When the files
+    together take more than max_bytes, the least recently used ones are
+    deleted until they fit in 90% of it. The total is kept as a running
+    count and the directory is only scanned when it may be over the limit,
+    so writes by other processes sharing the directory are noticed at the
+    next scan. Pass the cache as the cache= argument of search() or
+    search_page(), and bypass_cache=True to force a fresh request (whose
+    result then replaces the cached one).
+
+    Example:
+
+        cache = SearchCache('/tmp/yadle_search_cache', ttl=30)
+        res = search(bearer, appid, apiserver, 0, 20, None, terms, cache=cache)
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import yadle_search
+
+
+# Eviction trims the cache to this fraction of max_bytes, so a full cache is
+# not scanned again on the very next write.
+EVICT_TO = 0.9
+
+
+class SearchCache(object):
+
+    def __init__(self, directory, ttl=60, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None       # running total of the entry sizes; None until the directory is scanned
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, apiserver, appid, terms, skip, limit, quiet):
+        quiet = quiet == True or quiet == 'true'
+        skip = int(skip) if skip is not None else None
+        limit = int(limit) if limit is not None else None
+        parts = [apiserver.rstrip('/'), appid, yadle_search.normalize_terms(terms), skip, limit, quiet]
+        return hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, apiserver, appid, terms, skip, limit, quiet):
+        """ (url, result) of a cached search, or None. """
+        path = self._path(self.key(apiserver, appid, terms, skip, limit, quiet))
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+
+        if time.time() - entry['created'] >= self.ttl:
+            self._add_size(-self._remove(path))
+            self.misses += 1
+            return None
+
+        # Mark as recently used for eviction.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return entry['url'], entry['res']
+
+    def put(self, apiserver, appid, terms, skip, limit, quiet, url, res):
+        path = self._path(self.key(apiserver, appid, terms, skip, limit, quiet))
+        tmp_path = "{0}.{1}.{2}.tmp".format(path, os.getpid(), threading.get_ident())
+        text = json.dumps({'created': time.time(), 'url': url, 'res': res})
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+
+        try:
+            replaced = os.stat(path).st_size
+        except OSError:
+            replaced = 0
+        os.replace(tmp_path, path)
+
+        # Only scan the directory when the running total says it may be over budget.
+        size = self._add_size(len(text.encode('utf-8')) - replaced)
+        if size is None or size > self.max_bytes:
+            self.evict()
+
+    def _add_size(self, change):
+        with self._lock:
+            if self._size is not None:
+                self._size += change
+            return self._size
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the total size is at most
+        EVICT_TO times max_bytes. This scans the whole directory; put() only
+        calls it when the running total is unknown or over the budget.
+        """
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes * EVICT_TO:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+
+            self._size = total
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                self._remove(entry.path)
+        with self._lock:
+            self._size = None
+
+    def _remove(self, path):
+        # Delete one entry; returns its size, or 0 if it was already gone.
+        try:
+            size = os.stat(path).st_size
+            os.remove(path)
+        except OSError:
+            return 0
+        return size